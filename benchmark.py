@@ -0,0 +1,408 @@
+import os
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import argparse
+import tempfile
+import contextlib
+import tracemalloc
+import multiprocessing
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from aiohttp import web
+
+import merge_m3u
+import epg_grabber
+
+GROUPS = [
+    "Кинозал", "Новости", "SPORTS", "Досуг", "ПОЗНАВАТЕЛЬНЫЕ", "Музыка", "Детские",
+    "KIDS", "Эфирные", "UNITED STATES", "Премьеры,хиты", "Региoнальные",
+]
+NAMES = [
+    "Первый канал", "Россия 1", "НТВ HD", "Матч ТВ (FHD)", "Discovery UA", "Кино ТВ r1",
+    "CNN International", "Magenta Sport", "Мир", "Пятница! [720x576]", "ТНТ hd1", "Fox News",
+]
+HOSTS = ["cdn1.example.com", "edge.tvprovider.net", "live.ngenix.net", "stream.example.org", "10.0.0.5:8080"]
+USER_AGENTS = ["Mozilla/5.0 (Windows NT 10.0; Win64; x64)", "VLC/3.0.18 LibVLC/3.0.18"]
+TITLES = ["Новости", "Х/ф «Брат»", "Футбол. Премьер-лига", "Утро", "Documentary", "Weather", "Т/с «След»"]
+
+STAGES = ("parse", "check", "render", "epg")
+TS_PACKET = b"\x47" + bytes(187)
+TS_STREAM_LIMIT = 2 * 1024 * 1024
+
+def generate_m3u(entries, seed=1, stream_url=None):
+    rng = random.Random(seed)
+    lines = ["#EXTM3U"]
+    for index in range(entries):
+        name = rng.choice(NAMES)
+        attrs = f'tvg-id="ch{index}.tv" tvg-logo="http://logo.example.com/{index}.png"'
+        roll = rng.random()
+        if roll < 0.7:
+            attrs += f' group-title="{rng.choice(GROUPS)}"'
+        elif roll < 0.85:
+            lines.append(f"#EXTGRP:{rng.choice(GROUPS)}")
+        lines.append(f"#EXTINF:-1 {attrs},{name} {index}")
+        if rng.random() < 0.2:
+            lines.append(f"#EXTVLCOPT:http-user-agent={rng.choice(USER_AGENTS)}")
+        if rng.random() < 0.1:
+            lines.append(f"#EXTVLCOPT:http-referrer=https://{rng.choice(HOSTS)}/?ref={index}")
+        if stream_url:
+            lines.append(stream_url(index))
+        else:
+            lines.append(f"http://{rng.choice(HOSTS)}/live/{index}/index.m3u8?token={rng.getrandbits(32):x}")
+    return "\n".join(lines) + "\n"
+
+def generate_mock_m3u(entries, hosts, rtmp_address, seed=1):
+    # Смесь как в реальных источниках: в основном HLS, часть TS и немного RTMP
+    rng = random.Random(seed)
+
+    def stream_url(index):
+        roll = rng.random()
+        if roll < 0.6:
+            return f"http://{rng.choice(hosts)}/hls/{index}/master.m3u8"
+        if roll < 0.9:
+            return f"http://{rng.choice(hosts)}/ts/{index}.ts"
+        return f"rtmp://{rtmp_address}/live/{index}"
+
+    return generate_m3u(entries, seed, stream_url)
+
+def xmltv_time(moment):
+    return moment.strftime("%Y%m%d%H%M%S %z")
+
+def generate_xmltv(channels, days, programmes_per_day, seed=1, now=None):
+    rng = random.Random(seed)
+    now = now or datetime.now(timezone.utc)
+    start = (now - timedelta(days=1)).replace(minute=0, second=0, microsecond=0)
+    slot = timedelta(days=1) / programmes_per_day
+    parts = ['<?xml version="1.0" encoding="utf-8"?>\n<tv generator-info-name="benchmark">\n']
+    for index in range(channels):
+        parts.append(
+            f'  <channel id="ch{index}.tv">\n'
+            f'    <display-name lang="ru">{rng.choice(NAMES)} {index}</display-name>\n'
+            f'    <icon src="http://logo.example.com/{index}.png" />\n'
+            f'  </channel>\n'
+        )
+    for index in range(channels):
+        moment = start
+        for _ in range((days + 1) * programmes_per_day):
+            stop = moment + slot
+            parts.append(
+                f'  <programme start="{xmltv_time(moment)}" stop="{xmltv_time(stop)}" channel="ch{index}.tv">\n'
+                f'    <title lang="ru">{rng.choice(TITLES)}</title>\n'
+                f'    <desc lang="ru">Описание выпуска {rng.getrandbits(24):x}</desc>\n'
+                f'  </programme>\n'
+            )
+            moment = stop
+    parts.append("</tv>\n")
+    return "".join(parts)
+
+def peak_rss_kb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+# Мок-сервер потоков: поведение каждого канала детерминировано его номером
+def stream_fate(stream_id, options):
+    rng = random.Random(f"{options['seed']}:{stream_id}")
+    roll = rng.random()
+    if roll < options["failure_rate"] / 2:
+        return "error"
+    if roll < options["failure_rate"]:
+        return "dead-segments"
+    if roll < options["failure_rate"] + options["hang_rate"]:
+        return "hang"
+    return "ok"
+
+def create_mock_app(options):
+    latency = options["latency"]
+
+    @web.middleware
+    async def delay(request, handler):
+        if latency:
+            await asyncio.sleep(random.uniform(0.5, 1.5) * latency)
+        return await handler(request)
+
+    async def apply_fate(stream_id, segment=False):
+        fate = stream_fate(stream_id, options)
+        if fate == "hang":
+            await asyncio.sleep(options["hang_time"])
+        if fate == "error":
+            return web.Response(status=random.choice((404, 503)))
+        if fate == "dead-segments" and segment:
+            return web.Response(status=404)
+        return None
+
+    async def master(request):
+        stream_id = request.match_info["id"]
+        failed = await apply_fate(stream_id)
+        if failed:
+            return failed
+        body = (
+            "#EXTM3U\n"
+            "#EXT-X-STREAM-INF:BANDWIDTH=2560000,RESOLUTION=1280x720\nhigh.m3u8\n"
+            "#EXT-X-STREAM-INF:BANDWIDTH=800000,RESOLUTION=640x360\nlow.m3u8\n"
+        )
+        return web.Response(text=body, content_type="application/vnd.apple.mpegurl")
+
+    async def media(request):
+        sequence = int(time.time() // 6)
+        segments = "".join(f"#EXTINF:6.0,\nseg{sequence + n}.ts\n" for n in range(3))
+        body = f"#EXTM3U\n#EXT-X-TARGETDURATION:6\n#EXT-X-MEDIA-SEQUENCE:{sequence}\n{segments}"
+        return web.Response(text=body, content_type="application/vnd.apple.mpegurl")
+
+    async def segment(request):
+        failed = await apply_fate(request.match_info["id"], segment=True)
+        if failed:
+            return failed
+        return web.Response(body=TS_PACKET * 1024, content_type="video/mp2t")
+
+    async def transport_stream(request):
+        failed = await apply_fate(request.match_info["id"])
+        if failed:
+            return failed
+        response = web.StreamResponse(headers={"Content-Type": "video/mp2t"})
+        await response.prepare(request)
+        chunk = TS_PACKET * 64
+        sent = 0
+        # Бесконечный эфир, но с потолком, чтобы брошенные соединения не жили вечно
+        with contextlib.suppress(ConnectionError):
+            while sent < TS_STREAM_LIMIT:
+                await response.write(chunk)
+                sent += len(chunk)
+                await asyncio.sleep(0.01)
+        return response
+
+    app = web.Application(middlewares=[delay])
+    app.router.add_get("/hls/{id}/master.m3u8", master)
+    app.router.add_get("/hls/{id}/{variant}.m3u8", media)
+    app.router.add_get("/hls/{id}/{segment}.ts", segment)
+    app.router.add_get("/ts/{id}.ts", transport_stream)
+    return app
+
+async def handle_rtmp(reader, writer, options):
+    # RTMP-рукопожатие: на C0+C1 отвечаем S0+S1, C2 читаем и закрываем
+    try:
+        roll = random.random()
+        if roll < options["failure_rate"]:
+            return
+        if roll < options["failure_rate"] + options["hang_rate"]:
+            await asyncio.sleep(options["hang_time"])
+            return
+        await reader.readexactly(1 + 1536)
+        if options["latency"]:
+            await asyncio.sleep(options["latency"])
+        writer.write(b"\x03" + rtmp_s1() + bytes(1536))
+        await writer.drain()
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(reader.readexactly(1536), 5)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+def rtmp_s1():
+    return int(time.time()).to_bytes(4, "big") + bytes(4) + os.urandom(1528)
+
+async def serve_mock(options, ready):
+    runner = web.AppRunner(create_mock_app(options), access_log=None)
+    await runner.setup()
+    hosts = []
+    for host in options["hosts"]:
+        try:
+            await web.TCPSite(runner, host, options["port"]).start()
+            hosts.append(f"{host}:{options['port']}")
+        except OSError:
+            pass  # Не везде доступна вся сеть 127.0.0.0/8
+    rtmp = await asyncio.start_server(lambda r, w: handle_rtmp(r, w, options), "127.0.0.1", options["rtmp_port"])
+    ready.put(hosts)
+    async with rtmp:
+        await asyncio.Event().wait()
+
+def run_mock_server(options, ready):
+    asyncio.run(serve_mock(options, ready))
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+# Стадии: каждая запускается в отдельном процессе, чтобы пиковый RSS не смешивался
+def stage_parse(options):
+    with open(options["m3u_file"], encoding="utf-8") as f:
+        m3u_data = f.read()
+    best = None
+    for _ in range(options["repeat"]):
+        merge_m3u.clean_channel_name.cache_clear()
+        started = time.perf_counter()
+        channels = merge_m3u.parse_m3u(m3u_data)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    peak = peak_rss_kb()
+
+    urls = [channel.stream for channel in channels]
+    started = time.perf_counter()
+    blocked = sum(1 for url in urls if merge_m3u.is_blocked(url))
+    blocked_elapsed = time.perf_counter() - started
+
+    del channels, urls
+    tracemalloc.start()
+    channels = merge_m3u.parse_m3u(m3u_data)
+    retained, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "items": options["entries"], "unit": "entries", "wall": best, "peak_rss_kb": peak,
+        "detail": {
+            "channels": len(channels),
+            "bytes_per_channel": round(retained / len(channels)),
+            "is_blocked_per_s": round(len(channels) / blocked_elapsed),
+            "blocked": blocked,
+        },
+    }
+
+def stage_check(options):
+    with open(options["mock_m3u_file"], encoding="utf-8") as f:
+        channels = merge_m3u.parse_m3u(f.read())
+    started = time.perf_counter()
+    verdicts = asyncio.run(merge_m3u.check_channels(channels, probe_mode=options["probe_mode"], shards=options["shards"]))
+    elapsed = time.perf_counter() - started
+    reasons = Counter(verdict.reason or "ok" for verdict in verdicts)
+    return {
+        "items": len(channels), "unit": "streams", "wall": elapsed,
+        "detail": {"working": reasons.pop("ok", 0), "reasons": dict(reasons.most_common(8))},
+    }
+
+def stage_render(options):
+    with open(options["m3u_file"], encoding="utf-8") as f:
+        channels = merge_m3u.parse_m3u(f.read())
+    os.chdir(options["workdir"])
+    started = time.perf_counter()
+    merge_m3u.render_playlists(channels, "http://epg.example.com/epg.xml.gz")
+    elapsed = time.perf_counter() - started
+    sizes = {filename: os.path.getsize(filename) for filename, _, _ in merge_m3u.PLAYLIST_FORMATS.values()
+             if os.path.exists(filename)}
+    return {"items": len(channels), "unit": "channels", "wall": elapsed, "detail": {"bytes": sizes}}
+
+def stage_epg(options):
+    def chunks():
+        with open(options["xmltv_file"], "rb") as f:
+            while chunk := f.read(epg_grabber.CHUNK_SIZE):
+                yield chunk
+
+    # Примерно половина каналов гида есть в плейлисте
+    tvg_ids = {f"ch{index}.tv" for index in range(0, options["epg_channels"], 2)}
+    window = epg_grabber.epg_window(epg_grabber.EPG_WINDOW_PAST_HOURS, epg_grabber.EPG_WINDOW_FUTURE_DAYS)
+    output = os.path.join(options["workdir"], epg_grabber.EPG_GZ_FILE)
+    started = time.perf_counter()
+    result = epg_grabber.filter_epg(chunks(), tvg_ids, set(), window)
+    filtered = time.perf_counter()
+    epg_grabber.write_epg(epg_grabber.merge_epgs([result]), output, options["gzip_threads"])
+    elapsed = time.perf_counter() - started
+    return {
+        "items": options["xmltv_bytes"] / 1024 / 1024, "unit": "MiB", "wall": elapsed,
+        "detail": {
+            "channels": len(result["channels"]), "programmes": len(result["programmes"]),
+            "filter_s": round(filtered - started, 3), "write_s": round(elapsed - (filtered - started), 3),
+            "output_bytes": os.path.getsize(output),
+        },
+    }
+
+STAGE_RUNNERS = {"parse": stage_parse, "check": stage_check, "render": stage_render, "epg": stage_epg}
+
+def run_stage(name, options, results):
+    # Подробный вывод конвейера глушим, печатает только родитель
+    with open(os.devnull, "w", encoding="utf-8") as devnull, contextlib.redirect_stdout(devnull):
+        result = STAGE_RUNNERS[name](options)
+    result.setdefault("peak_rss_kb", peak_rss_kb())
+    results.put(result)
+
+def report_stage(name, result):
+    rate = result["items"] / result["wall"] if result["wall"] else 0
+    rss = f"{result['peak_rss_kb'] / 1024:,.1f} MiB" if result["peak_rss_kb"] else "n/a"
+    print(f"{name:<7} {result['wall']:>9.3f}s {rate:>14,.1f} {result['unit']}/s   peak RSS {rss}")
+    for key, value in result["detail"].items():
+        print(f"        {key}: {value}")
+
+def run_benchmark(args):
+    context = multiprocessing.get_context("spawn")
+    workdir = tempfile.mkdtemp(prefix="playlist-bench-")
+    options = {
+        "entries": args.entries, "repeat": args.repeat, "probe_mode": args.probe_mode, "shards": args.shards,
+        "epg_channels": args.epg_channels, "gzip_threads": args.gzip_threads, "workdir": workdir,
+        "m3u_file": os.path.join(workdir, "source.m3u"),
+        "mock_m3u_file": os.path.join(workdir, "mock.m3u"),
+        "xmltv_file": os.path.join(workdir, "guide.xml"),
+    }
+
+    if "parse" in args.stages or "render" in args.stages:
+        with open(options["m3u_file"], "w", encoding="utf-8") as f:
+            f.write(generate_m3u(args.entries))
+    if "epg" in args.stages:
+        with open(options["xmltv_file"], "w", encoding="utf-8") as f:
+            f.write(generate_xmltv(args.epg_channels, args.epg_days, args.programmes_per_day))
+        options["xmltv_bytes"] = os.path.getsize(options["xmltv_file"])
+
+    server = None
+    if "check" in args.stages:
+        mock_options = {
+            "hosts": [f"127.0.0.{n}" for n in range(1, args.hosts + 1)], "port": free_port(),
+            "rtmp_port": free_port(), "latency": args.latency, "failure_rate": args.failure_rate,
+            "hang_rate": args.hang_rate, "hang_time": args.hang_time, "seed": 1,
+        }
+        ready = context.Queue()
+        server = context.Process(target=run_mock_server, args=(mock_options, ready), daemon=True)
+        server.start()
+        hosts = ready.get(timeout=30)
+        with open(options["mock_m3u_file"], "w", encoding="utf-8") as f:
+            f.write(generate_mock_m3u(args.streams, hosts, f"127.0.0.1:{mock_options['rtmp_port']}"))
+        print(f"Mock stream server on {', '.join(hosts)}, RTMP on port {mock_options['rtmp_port']}")
+
+    report = {}
+    try:
+        for name in args.stages:
+            results = context.Queue()
+            process = context.Process(target=run_stage, args=(name, options, results))
+            process.start()
+            report[name] = results.get()
+            process.join()
+            report_stage(name, report[name])
+    finally:
+        if server:
+            server.terminate()
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the playlist pipeline on synthetic data.")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=list(STAGES), help="Stages to run")
+    parser.add_argument("--entries", type=int, default=100_000, help="Number of #EXTINF entries to generate")
+    parser.add_argument("--repeat", type=int, default=3, help="Parse runs per measurement, the best one is reported")
+    parser.add_argument("--streams", type=int, default=2000, help="Streams to validate against the mock server")
+    parser.add_argument("--hosts", type=int, default=4, help="Loopback addresses the mock server listens on")
+    parser.add_argument("--latency", type=float, default=0.05, help="Mean response delay of the mock server, seconds")
+    parser.add_argument("--failure-rate", type=float, default=0.1, help="Share of broken streams")
+    parser.add_argument("--hang-rate", type=float, default=0.01, help="Share of streams that never answer in time")
+    parser.add_argument("--hang-time", type=float, default=30, help="How long a hanging stream stalls, seconds")
+    parser.add_argument("--probe-mode", choices=merge_m3u.PROBE_MODES, default="basic", help="Stream probe mode")
+    parser.add_argument("--shards", type=int, default=merge_m3u.VALIDATION_SHARDS, help="Validation processes for the check stage")
+    parser.add_argument("--epg-channels", type=int, default=2000, help="Channels in the synthetic XMLTV guide")
+    parser.add_argument("--epg-days", type=int, default=7, help="Days of programmes per channel")
+    parser.add_argument("--programmes-per-day", type=int, default=24, help="Programmes per channel and day")
+    parser.add_argument("--gzip-threads", type=int, default=1, help="Threads for the EPG compressor")
+    parser.add_argument("--json", help="Also write the measurements to this JSON file")
+    args = parser.parse_args()
+
+    run_benchmark(args)
@@ -1,51 +1,102 @@
 import requests
-import xmltodict
-import shutil
 import os
+import sys
+import io
 import gzip
 import re
-import sys
+import struct
+import time
+import zlib
+import calendar
+import argparse
+import functools
+import xml.etree.ElementTree as ET
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from manifest import UNCHANGED_EXIT_CODE, content_digest, is_unchanged, record_manifest
+from run_metrics import LOG_LEVELS, log, metrics, setup_logging
 
 # Files
 M3U_FILE = "televizo.m3u"
 EPG_GZ_FILE = "myepg.xml.gz"
-EPG_XML_FILE = "epg.xml"
-OUTPUT_EPG = "my-epg.xml"
-
-# 1. Download and extract EPG if needed
-def download_epg(url, epg_file):
-    response = requests.get(url, stream=True)
-    if response.status_code == 200:
-        with open(epg_file, "wb") as f:
-            f.write(response.content)
-        print(f"✅ EPG downloaded successfully: {url}")
-
-        with open(epg_file, "rb") as f:
-            if f.read(2) == b"\x1f\x8b":
-                print("📦 EPG is archived, extracting...")
-                with gzip.open(epg_file, "rb") as gz:
-                    with open(EPG_XML_FILE, "wb") as xml_f:
-                        xml_f.write(gz.read())
-                print("✅ EPG extracted successfully.")
+CHUNK_SIZE = 1024 * 1024
+GZIP_LEVEL = 9
+GZIP_BLOCK_SIZE = 1024 * 1024
+MAX_PARALLEL_DOWNLOADS = 8
+
+# Окно публикуемой программы: от "сейчас минус N часов" до "сейчас плюс N дней"
+EPG_WINDOW_PAST_HOURS = 2
+EPG_WINDOW_FUTURE_DAYS = 3
+# Границы окна расширяются наружу до шага (по UTC): запуски в пределах шага дают один и тот же гид,
+# а запрошенный интервал всегда целиком внутри окна. Каждый край сдвигается не более чем на шаг,
+# поэтому шаг равен интервалу между запусками по cron (3 ч), а не суткам
+EPG_WINDOW_STEP_HOURS = 3
+
+RUN_REPORT_FILE = os.path.join(".cache", "epg_report.json")
+
+# 1. Download EPG and decompress it on the fly, without temporary files
+def iter_epg_chunks(response):
+    decompressor = None
+    head = b""
+    for chunk in response.iter_content(CHUNK_SIZE):
+        if decompressor is None:
+            head += chunk
+            if len(head) < 2:
+                continue
+            if head[:2] == b"\x1f\x8b":
+                log.info("📦 EPG is archived, extracting on the fly: %s", response.url)
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
             else:
-                print("✅ EPG is not archived. Using as is.")
-                os.rename(epg_file, EPG_XML_FILE)
-
-        if os.path.exists(epg_file):
-            try:
-                os.remove(epg_file)
-                print(f"✅ Removed archive: {epg_file}")
-            except PermissionError as e:
-                print(f"❌ Failed to remove {epg_file}: {e}")
-    else:
-        print(f"❌ Failed to download EPG: {url}, HTTP Status: {response.status_code}")
-        exit()
+                decompressor = False
+            chunk, head = head, b""
+        if not decompressor:
+            yield chunk
+            continue
+        while chunk:
+            yield decompressor.decompress(chunk)
+            # gzip может состоять из нескольких склеенных частей
+            chunk = decompressor.unused_data if decompressor.eof else b""
+            if chunk:
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if decompressor is None and head:
+        yield head
+    elif decompressor:
+        yield decompressor.flush()
+
+def download_epg(url, m3u_tvg_ids, m3u_channel_names, window=None, timeout=60):
+    try:
+        with metrics.stage("epg.download"), requests.get(url, stream=True, timeout=timeout) as response:
+            if response.status_code != 200:
+                log.error("❌ Failed to download EPG: %s, HTTP Status: %s", url, response.status_code)
+                metrics.failure("epg.download", f"HTTP {response.status_code}")
+                return None
+            result = filter_epg(iter_epg_chunks(response), m3u_tvg_ids, m3u_channel_names, window)
+    except (requests.RequestException, ET.ParseError, zlib.error) as e:
+        log.error("❌ Failed to process EPG: %s: %s", url, e)
+        metrics.failure("epg.download", type(e).__name__)
+        return None
+
+    log.info("✅ EPG downloaded successfully: %s", url)
+    result["url"] = url
+    return result
+
+def download_epgs(urls, m3u_tvg_ids, m3u_channel_names, window=None):
+    with ThreadPoolExecutor(max_workers=min(len(urls), MAX_PARALLEL_DOWNLOADS)) as executor:
+        results = list(executor.map(lambda url: download_epg(url, m3u_tvg_ids, m3u_channel_names, window), urls))
+
+    failed = [url for url, result in zip(urls, results) if result is None]
+    if failed:
+        log.warning("⚠️ Skipped %d of %d EPG sources: %s", len(failed), len(urls), ", ".join(failed))
+    metrics.count("epg.sources.ok", len(urls) - len(failed))
+    metrics.count("epg.sources.failed", len(failed))
+    return [result for result in results if result is not None]
 
 # 2. Read M3U playlist and extract tvg-ids & channel names
 def get_m3u_data(m3u_file):
     if not os.path.exists(m3u_file):
-        print(f"❌ File not found: {m3u_file}")
-        exit()
+        log.error("❌ File not found: %s", m3u_file)
+        sys.exit(1)
 
     tvg_ids = set()
     channel_names = set()
@@ -63,113 +114,335 @@ def get_m3u_data(m3u_file):
                 if name_match:
                     channel_names.add(name_match.group(1).strip().lower())
 
-    print(f"✅ Found {len(tvg_ids)} unique tvg-ids in M3U.")
-    print(f"✅ Found {len(channel_names)} unique channel names in M3U.")
+    log.info("✅ Found %d unique tvg-ids in M3U.", len(tvg_ids))
+    log.info("✅ Found %d unique channel names in M3U.", len(channel_names))
     return tvg_ids, channel_names
 
 # 🔧 Вспомогательная функция для безопасного получения display-name
-def normalize_display_names(display):
-    names = []
-    if isinstance(display, list):
-        for name in display:
-            if isinstance(name, dict):
-                names.append(name.get("#text", "").strip().lower())
-            else:
-                names.append(str(name).strip().lower())
-    else:
-        if isinstance(display, dict):
-            names.append(display.get("#text", "").strip().lower())
-        else:
-            names.append(str(display).strip().lower())
-    return names
+def normalize_display_names(channel):
+    return [(name.text or "").strip().lower() for name in channel.findall("display-name")]
+
+# Потоковый разбор XMLTV: элементы верхнего уровня (<channel>, <programme>)
+# отдаются по одному и сразу удаляются из дерева, память не растёт с размером файла
+def iter_epg_elements(chunks):
+    parser = ET.XMLPullParser(events=("start", "end"))
+    depth = 0
+    root = None
+
+    def drain():
+        nonlocal depth, root
+        for event, elem in parser.read_events():
+            if event == "start":
+                depth += 1
+                if depth == 1:
+                    root = elem
+                continue
+            depth -= 1
+            if depth == 1:
+                elem.tail = None
+                yield elem
+                root.clear()
+
+    for chunk in chunks:
+        started = time.perf_counter()
+        parser.feed(chunk)
+        metrics.add_time("epg.parse", time.perf_counter() - started)
+        metrics.count("epg.bytes", len(chunk))
+        yield from drain()
+    parser.close()
+    yield from drain()
+
+def serialize_element(elem):
+    # Отступы исходного файла не нужны в выходном: убираем пробельные text/tail у вложенных элементов
+    for child in elem.iter():
+        if child.tail is not None and not child.tail.strip():
+            child.tail = None
+        if len(child) and child.text is not None and not child.text.strip():
+            child.text = None
+    return ET.tostring(elem, encoding="unicode") + "\n"
+
+# Время XMLTV: "YYYYmmddHHMMSS +HHMM"; начало суток кэшируется, остальное - простая арифметика
+@functools.lru_cache(maxsize=4096)
+def xmltv_day_start(date):
+    return calendar.timegm((int(date[0:4]), int(date[4:6]), int(date[6:8]), 0, 0, 0))
+
+def parse_xmltv_time(value):
+    try:
+        value = value.strip()
+        digits = len(value) - len(value.lstrip("0123456789"))
+        timestamp, offset = value[:digits], value[digits:].strip()
+        seconds = xmltv_day_start(timestamp[:8])
+        seconds += int(timestamp[8:10] or 0) * 3600 + int(timestamp[10:12] or 0) * 60 + int(timestamp[12:14] or 0)
+        if len(offset) >= 5 and offset[0] in "+-":
+            shift = int(offset[1:3]) * 3600 + int(offset[3:5]) * 60
+            seconds -= shift if offset[0] == "+" else -shift
+        return seconds
+    except (ValueError, IndexError):
+        return None
+
+def epg_window(past_hours=EPG_WINDOW_PAST_HOURS, future_days=EPG_WINDOW_FUTURE_DAYS, now=None, step_hours=0):
+    now = time.time() if now is None else now
+    start, end = now - past_hours * 3600, now + future_days * 86400
+    if step_hours:
+        step = step_hours * 3600
+        start -= start % step
+        end += -end % step
+    return start, end
+
+def programme_interval(programme):
+    start = parse_xmltv_time(programme.get("start", ""))
+    if start is None:
+        return None, None
+    return start, parse_xmltv_time(programme.get("stop", "")) or start
+
+def in_window(start, stop, window):
+    if start is None:
+        return True
+    return stop > window[0] and start < window[1]
 
 # 3. Filter EPG based on M3U tvg-ids and names
-def filter_epg(m3u_tvg_ids, m3u_channel_names):
-    if not os.path.exists(EPG_XML_FILE):
-        print("❌ EPG file not found! Exiting...")
-        exit()
-
-    with open(EPG_XML_FILE, "r", encoding="utf-8") as f:
-        epg_data = xmltodict.parse(f.read())
-
-    if "tv" not in epg_data or "channel" not in epg_data["tv"]:
-        print("❌ Error: EPG file is empty or has an incorrect format.")
-        exit()
-
+# Один проход по потоку: секция <channel> по стандарту XMLTV идёт перед программами,
+# поэтому к моменту первой <programme> список подходящих каналов уже собран.
+# В памяти остаются только отфильтрованные элементы, а не весь исходный файл.
+def filter_epg(chunks, m3u_tvg_ids, m3u_channel_names, window=None):
     filtered_channels = []
-    new_programs = []
-    epg_channel_map = {}
-
-    for channel in epg_data["tv"]["channel"]:
-        channel_id = channel["@id"].strip().lower()
-        display_names = normalize_display_names(channel.get("display-name", []))
-        epg_channel_map[channel_id] = display_names
-
     valid_channel_ids = set()
-    for channel_id, names in epg_channel_map.items():
-        if channel_id in m3u_tvg_ids or any(name in m3u_channel_names for name in names):
-            valid_channel_ids.add(channel_id)
-
-    print(f"✅ Found {len(valid_channel_ids)} matching channels in EPG.")
-
-    for channel in epg_data["tv"]["channel"]:
-        if channel["@id"].strip().lower() in valid_channel_ids:
-            filtered_channels.append(channel)
-
-    for program in epg_data["tv"].get("programme", []):
-        if program["@channel"].strip().lower() in valid_channel_ids:
-            new_programs.append(program)
-
-    epg_data["tv"]["channel"] = filtered_channels
-    epg_data["tv"]["programme"] = new_programs
-
-    with open(OUTPUT_EPG, "w", encoding="utf-8") as f:
-        f.write(xmltodict.unparse(epg_data, pretty=True))
-
-    print(f"✅ Filtered EPG saved as {OUTPUT_EPG}")
-
-    with open(OUTPUT_EPG, "rb") as f_in:
-        with gzip.open(EPG_GZ_FILE, "wb") as f_out:
-            shutil.copyfileobj(f_in, f_out)
-
-    print(f"✅ Filtered EPG archived as {EPG_GZ_FILE}")
-
-    if os.path.exists(EPG_XML_FILE):
-        try:
-            os.remove(EPG_XML_FILE)
-            print(f"✅ Removed temporary file: {EPG_XML_FILE}")
-        except PermissionError as e:
-            print(f"❌ Failed to remove {EPG_XML_FILE}: {e}")
-
-    if os.path.exists(OUTPUT_EPG):
+    new_programs = []
+    channel_count = 0
+    pruned_count = 0
+    started = time.perf_counter()
+
+    for elem in iter_epg_elements(chunks):
+        if elem.tag == "channel":
+            channel_count += 1
+            channel_id = elem.get("id", "").strip().lower()
+            display_names = normalize_display_names(elem)
+            if channel_id in m3u_tvg_ids or any(name in m3u_channel_names for name in display_names):
+                valid_channel_ids.add(channel_id)
+                filtered_channels.append((channel_id, serialize_element(elem)))
+        elif elem.tag == "programme":
+            channel_id = elem.get("channel", "").strip().lower()
+            if channel_id not in valid_channel_ids and channel_id not in m3u_tvg_ids:
+                continue
+            start, stop = programme_interval(elem)
+            if window and not in_window(start, stop, window):
+                pruned_count += 1
+                continue
+            # Канал и интервал хранятся рядом с текстом: слиянию источников не нужно разбирать XML повторно
+            new_programs.append((channel_id, start, stop, serialize_element(elem)))
+
+    # Включает время разбора XML (epg.parse) и чтения потока: фильтр работает по мере поступления данных
+    metrics.add_time("epg.filter", time.perf_counter() - started)
+    if not channel_count:
+        raise ET.ParseError("EPG file is empty or has an incorrect format")
+
+    log.info("✅ Found %d matching channels and %d programmes in EPG.", len(valid_channel_ids), len(new_programs))
+    if pruned_count:
+        log.info("✂️ Dropped %d programmes outside the time window.", pruned_count)
+    metrics.count("epg.channels.read", channel_count)
+    metrics.count("epg.channels.kept", len(filtered_channels))
+    metrics.count("epg.programmes.kept", len(new_programs))
+    metrics.count("epg.programmes.pruned", pruned_count)
+    return {"channels": filtered_channels, "channel_ids": valid_channel_ids, "programmes": new_programs}
+
+def source_priorities(epg_results, preferred=()):
+    # Меньше - важнее: сначала источники из preferred, затем остальные в порядке URL
+    preferred = list(preferred)
+    order = {url: rank for rank, url in enumerate(preferred)}
+    return [order.get(result.get("url"), len(preferred) + index) for index, result in enumerate(epg_results)]
+
+# 4. Merge the sources into one guide
+# Каналы с одинаковым id берутся из самого приоритетного источника. Программы каждого
+# канала сортируются по (начало, приоритет) и проходятся один раз: передача, пересекающая
+# уже принятые, отбрасывается, если хотя бы одна из них не хуже по приоритету, иначе
+# вытесняет их. Точные дубликаты - частный случай пересечения.
+def merge_epgs(epg_results, preferred=()):
+    priorities = source_priorities(epg_results, preferred)
+    ranked = sorted(zip(priorities, range(len(epg_results)), epg_results), key=lambda item: item[:2])
+
+    channels = {}
+    timelines = {}
+    untimed = []
+    duplicate_channels = 0
+    for priority, _, result in ranked:
+        for channel_id, xml in result["channels"]:
+            if channel_id in channels:
+                duplicate_channels += 1
+                continue
+            channels[channel_id] = xml
+        for seq, (channel_id, start, stop, xml) in enumerate(result["programmes"]):
+            if start is None:
+                untimed.append(xml)
+                continue
+            timelines.setdefault(channel_id, []).append((start, priority, seq, stop, xml))
+
+    programmes = []
+    dropped = 0
+    displaced = 0
+    # Порядок каналов - как у элементов <channel>, затем каналы, для которых есть только программы
+    ordered = [channel_id for channel_id in channels if channel_id in timelines]
+    ordered += [channel_id for channel_id in timelines if channel_id not in channels]
+    for channel_id in ordered:
+        accepted = []
+        for candidate in sorted(timelines[channel_id]):
+            start, priority = candidate[0], candidate[1]
+            # Принятые не пересекаются и отсортированы, поэтому пересечься с кандидатом может только хвост
+            overlap = len(accepted)
+            while overlap and accepted[overlap - 1][3] > start:
+                overlap -= 1
+            if any(kept[1] <= priority for kept in accepted[overlap:]):
+                dropped += 1
+                continue
+            displaced += len(accepted) - overlap
+            del accepted[overlap:]
+            accepted.append(candidate)
+        programmes.extend(item[4] for item in accepted)
+    programmes.extend(untimed)
+
+    total = sum(len(result["programmes"]) for result in epg_results)
+    if len(epg_results) > 1 or dropped or displaced:
+        log.info("🔀 Merged %d EPG sources: %d channels, %d programmes (%d duplicate channels, %d overlapping programmes dropped).",
+                 len(epg_results), len(channels), len(programmes), duplicate_channels, total - len(programmes))
+    metrics.count("epg.merge.channels.duplicate", duplicate_channels)
+    metrics.count("epg.merge.programmes.dropped", dropped)
+    metrics.count("epg.merge.programmes.displaced", displaced)
+    metrics.count("epg.programmes.published", len(programmes))
+    return {"channels": list(channels.values()), "programmes": programmes}
+
+def guide_digest(guide):
+    # Хэш ровно того, что попадёт в архив, но без затрат на сжатие
+    return content_digest(part for key in ("channels", "programmes") for part in guide[key])
+
+# 5. Write the merged guide straight into the gzip archive
+def compress_block(block, dictionary, last):
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=dictionary) if dictionary else \
+        zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+class ParallelGzipWriter(io.RawIOBase):
+    """Gzip writer that deflates fixed-size blocks on several threads, like pigz.
+
+    Each block is primed with the last 32 KiB of the previous one and
+    ended with a sync flush, so the blocks join into a single ordinary
+    gzip member that any client can read.
+    """
+
+    def __init__(self, fileobj, threads):
+        super().__init__()
+        self.fileobj = fileobj
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.pending = deque()
+        self.max_pending = threads * 2
+        self.buffer = bytearray()
+        self.dictionary = b""
+        self.crc = 0
+        self.size = 0
+        self.fileobj.write(b"\x1f\x8b\x08\x00" + struct.pack("<I", int(time.time())) + b"\x02\xff")
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        while len(self.buffer) >= GZIP_BLOCK_SIZE:
+            block = bytes(self.buffer[:GZIP_BLOCK_SIZE])
+            del self.buffer[:GZIP_BLOCK_SIZE]
+            self.submit(block, last=False)
+        return len(data)
+
+    def submit(self, block, last):
+        self.pending.append(self.executor.submit(compress_block, block, self.dictionary, last))
+        self.dictionary = block[-32768:]
+        while len(self.pending) > self.max_pending:
+            self.fileobj.write(self.pending.popleft().result())
+
+    def close(self):
+        if self.closed:
+            return
         try:
-            os.remove(OUTPUT_EPG)
-            print(f"✅ Removed temporary file: {OUTPUT_EPG}")
-        except PermissionError as e:
-            print(f"❌ Failed to remove {OUTPUT_EPG}: {e}")
+            self.submit(bytes(self.buffer), last=True)
+            while self.pending:
+                self.fileobj.write(self.pending.popleft().result())
+            self.fileobj.write(struct.pack("<II", self.crc & 0xffffffff, self.size & 0xffffffff))
+        finally:
+            self.executor.shutdown()
+            self.fileobj.close()
+            super().close()
+
+def open_epg_output(path, threads=1):
+    if threads > 1:
+        return io.TextIOWrapper(ParallelGzipWriter(open(path, "wb"), threads), encoding="utf-8")
+    return gzip.open(path, "wt", encoding="utf-8", compresslevel=GZIP_LEVEL)
+
+def write_epg_xml(f, guide):
+    f.write('<?xml version="1.0" encoding="utf-8"?>\n<tv>\n')
+    f.writelines(guide["channels"])
+    f.writelines(guide["programmes"])
+    f.write("</tv>\n")
+
+def render_epg(guide):
+    # Архив целиком в памяти; mtime=0 - одинаковый гид даёт одинаковые байты
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode="wb", compresslevel=GZIP_LEVEL, mtime=0) as archive:
+        with io.TextIOWrapper(archive, encoding="utf-8") as f:
+            write_epg_xml(f, guide)
+    return buffer.getvalue()
+
+def write_epg(guide, output=EPG_GZ_FILE, threads=1):
+    tmp_output = f"{output}.tmp"
+    with open_epg_output(tmp_output, threads) as f:
+        write_epg_xml(f, guide)
+    os.replace(tmp_output, output)
+
+    log.info("✅ Filtered EPG archived as %s", output)
 
 # 🔥 Main process
 if __name__ == "__main__":
-    epg_urls = sys.argv[1:]
+    parser = argparse.ArgumentParser(description="Download, filter and archive XMLTV guides for the merged playlist.")
+    parser.add_argument("epg_urls", nargs="*", help="EPG URLs (plain or gzipped XMLTV)")
+    parser.add_argument("--past-hours", type=float, default=EPG_WINDOW_PAST_HOURS,
+                        help="Keep at least the programmes that ended this many hours ago")
+    parser.add_argument("--future-days", type=float, default=EPG_WINDOW_FUTURE_DAYS,
+                        help="Keep at least the programmes that start this many days ahead")
+    parser.add_argument("--window-step", type=float, default=EPG_WINDOW_STEP_HOURS,
+                        help="Widen both window ends outward to multiples of this many hours (UTC) so runs within a step produce the same guide; each end moves by less than one step, so the window grows by up to 2x this value (default %(default)s h); 0 disables")
+    parser.add_argument("--keep-all", action="store_true", help="Disable time-window pruning")
+    parser.add_argument("--prefer", action="append", default=[], metavar="EPG_URL",
+                        help="Source whose programmes win overlapping time slots; repeat to rank several, the rest follow in URL order")
+    parser.add_argument("--gzip-threads", type=int, default=1,
+                        help="Compress the guide with this many threads (pigz-style blocks) instead of plain gzip")
+    parser.add_argument("--log-level", choices=LOG_LEVELS, default="INFO", help="Logging verbosity")
+    parser.add_argument("--report", default=RUN_REPORT_FILE, help="Where to write the JSON run report")
+    parser.add_argument("--force", action="store_true", help="Rewrite the archive even if the filtered guide is unchanged")
+    args = parser.parse_args()
+    setup_logging(args.log_level)
+    epg_urls = args.epg_urls
 
     if not epg_urls:
-        print("❌ No EPG URLs provided! Usage: python script.py <EPG_URL1> <EPG_URL2> ...")
-        exit()
-
-    combined_epg = {"tv": {"channel": [], "programme": []}}
-
-    for index, url in enumerate(epg_urls, start=1):
-        epg_file = f"epg_{index}.xml.gz"
-        download_epg(url, epg_file)
-
-        with open(EPG_XML_FILE, "r", encoding="utf-8") as f:
-            epg_data = xmltodict.parse(f.read())
-
-        combined_epg["tv"]["channel"].extend(epg_data["tv"]["channel"])
-        combined_epg["tv"]["programme"].extend(epg_data["tv"].get("programme", []))
-
-    with open(EPG_XML_FILE, "w", encoding="utf-8") as f:
-        f.write(xmltodict.unparse(combined_epg, pretty=True))
+        log.error("❌ No EPG URLs provided! Usage: python script.py <EPG_URL1> <EPG_URL2> ...")
+        sys.exit(1)
 
+    window = None if args.keep_all else epg_window(args.past_hours, args.future_days, step_hours=args.window_step)
     m3u_tvg_ids, m3u_channel_names = get_m3u_data(M3U_FILE)
-    filter_epg(m3u_tvg_ids, m3u_channel_names)
+    epg_results = download_epgs(epg_urls, m3u_tvg_ids, m3u_channel_names, window)
+
+    if not epg_results:
+        log.error("❌ No EPG sources could be downloaded! Exiting...")
+        metrics.write_report(args.report, script="epg_grabber", sources=len(epg_urls))
+        sys.exit(1)
+
+    with metrics.stage("epg.merge"):
+        guide = merge_epgs(epg_results, args.prefer)
+    digest = guide_digest(guide)
+    if not args.force and is_unchanged("epg", digest, [EPG_GZ_FILE]):
+        log.info("✅ Filtered EPG unchanged since the last run, keeping %s", EPG_GZ_FILE)
+        metrics.count("epg.unchanged")
+        metrics.write_report(args.report, script="epg_grabber", sources=len(epg_urls), changed=False)
+        sys.exit(UNCHANGED_EXIT_CODE)
+
+    with metrics.stage("epg.compress"):
+        write_epg(guide, threads=args.gzip_threads)
+    record_manifest("epg", digest, [EPG_GZ_FILE])
+    metrics.write_report(args.report, script="epg_grabber", sources=len(epg_urls), changed=True)
@@ -0,0 +1,52 @@
+import os
+import json
+import time
+import hashlib
+
+MANIFEST_FILE = os.path.join(".cache", "manifest.json")
+# Увеличить при изменении формата выходных файлов, чтобы следующий запуск их перезаписал
+MANIFEST_VERSION = 1
+# Код выхода "ничего не изменилось": по нему workflow пропускает публикацию
+UNCHANGED_EXIT_CODE = 10
+
+def content_digest(parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+def load_manifest(path=MANIFEST_FILE):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def output_sizes(outputs):
+    return {output: os.path.getsize(output) for output in outputs if os.path.exists(output)}
+
+def is_unchanged(section, digest, outputs, path=MANIFEST_FILE):
+    # Совпадения хэша мало: выходные файлы должны быть на месте и того же размера, что и при записи
+    entry = load_manifest(path).get(section)
+    return bool(entry) \
+        and entry.get("version") == MANIFEST_VERSION \
+        and entry.get("digest") == digest \
+        and entry.get("outputs") == output_sizes(outputs) \
+        and len(entry["outputs"]) == len(outputs)
+
+def record_manifest(section, digest, outputs, path=MANIFEST_FILE):
+    manifest = load_manifest(path)
+    manifest[section] = {
+        "version": MANIFEST_VERSION,
+        "digest": digest,
+        "outputs": output_sizes(outputs),
+        "updated_at": int(time.time()),
+    }
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
@@ -1,79 +1,724 @@
 import re
+import os
+import sys
+import codecs
+import json
+import gzip
+import time
+import sqlite3
+import hashlib
 import asyncio
 import aiohttp
-import socket
 import argparse
+import functools
+import contextlib
 import streamlink
+import multiprocessing
+from collections import deque, namedtuple
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode, urljoin
 from concurrent.futures import ThreadPoolExecutor
 
+from manifest import UNCHANGED_EXIT_CODE, content_digest, is_unchanged, record_manifest
+from run_metrics import LOG_LEVELS, log, metrics, setup_logging
+
 BLOCKLIST = ["ngenix.net", "zabava", "ott.tricolor.tv","cdn2.ntv.ru","cdn.ntv.ru"]
-MAX_CONCURRENT_CHECKS = 5
-semaphore = asyncio.Semaphore(MAX_CONCURRENT_CHECKS)
+MAX_CONCURRENT_CHECKS = 64
+
+HTTP_POOL_LIMIT = 100
+HTTP_POOL_LIMIT_PER_HOST = 8
+
+# Адаптивные лимиты на хост: растут, пока хост отвечает быстро, и падают вдвое при таймаутах и троттлинге.
+# Троттлинг - это 429 или 503 с Retry-After: голый 503 мёртвого канала на IPTV-источниках обычен и хост не тормозит
+HOST_INITIAL_CONCURRENCY = 2
+HOST_MAX_CONCURRENCY = HTTP_POOL_LIMIT_PER_HOST
+HOST_SLOW_LATENCY = 2.0
+HOST_THROTTLE_COOLDOWN = 5.0
+HOST_MAX_COOLDOWN = 30.0
+
+# Предохранитель на хост: если в скользящем окне почти одни отказы, цепь размыкается и каналы хоста
+# не проверяются; после паузы один пробный запрос решает, замкнуть её или подождать ещё
+HOST_CIRCUIT_WINDOW = 20
+HOST_CIRCUIT_MIN_SAMPLES = 5
+HOST_CIRCUIT_FAILURE_RATIO = 0.8
+HOST_CIRCUIT_COOLDOWN = 30.0
+CIRCUIT_CLOSED, CIRCUIT_OPEN, CIRCUIT_HALF_OPEN = "closed", "open", "half-open"
+CIRCUIT_OPEN_REASON = "circuit open"
+
+# Резервная проверка через Streamlink идёт в отдельных процессах, которые убиваются по таймауту
+STREAMLINK_WORKERS = 4
+STREAMLINK_TIMEOUT = 3
+STREAMLINK_STARTUP_TIMEOUT = 30
+STREAMLINK_TOTAL_BUDGET = 60
+# Проверку можно разбить по процессам: у каждого свой цикл событий, сессия и планировщик, каналы делятся по хосту
+VALIDATION_SHARDS = 1
+SHARD_SHUTDOWN_TIMEOUT = 30
+HTTP_KEEPALIVE_TIMEOUT = 30
+DNS_CACHE_TTL = 600
+
+CACHE_DIR = ".cache"
+PLAYLIST_CACHE_DIR = os.path.join(CACHE_DIR, "playlists")
+# Увеличить при изменении parse_m3u, чтобы закэшированные списки каналов были пересобраны
+PARSE_CACHE_VERSION = 3
+
+HEALTH_DB_FILE = os.path.join(CACHE_DIR, "stream_health.sqlite")
+HEALTH_TTL_HOURS = 6
+HEALTH_RETENTION_DAYS = 30
+
+# Конвейер: источник разбирается по мере загрузки, каждый канал проверяется своей задачей;
+# число ещё не проверенных каналов ограничено, при переполнении загрузка приостанавливается
+PIPELINE_CHUNK_SIZE = 64 * 1024
+PIPELINE_MAX_PENDING = 1000
+
+RUN_REPORT_FILE = os.path.join(CACHE_DIR, "merge_report.json")
+EPG_RELEASE_URL = "https://github.com/DonaIdTrump2024/playlist/releases/download/m3u/myepg.xml.gz"
+
+# Источник конвейера: check - проверять ли потоки, keep - необязательный фильтр каналов
+PlaylistSource = namedtuple("PlaylistSource", ["url", "check", "keep"], defaults=(True, None))
+
+StreamVerdict = namedtuple("StreamVerdict", ["ok", "latency", "reason", "ttfb", "throughput"], defaults=(None, None))
+
+# Глубокая проверка HLS: мастер-плейлист -> один вариант -> начало одного сегмента, в пределах бюджета
+PROBE_MODES = ("basic", "deep")
+PROBE_BYTE_BUDGET = 512 * 1024
+PROBE_TIME_BUDGET = 8
+PROBE_SEGMENT_BYTES = 128 * 1024
+PROBE_BUDGET_REASON = "probe budget exhausted"
+
+# RTMP: поток считается живым, только если сервер ответил на рукопожатие (S0+S1)
+RTMP_DEFAULT_PORT = 1935
+RTMP_VERSION = 3
+RTMP_HANDSHAKE_SIZE = 1536
+RTMP_HANDSHAKE_TIMEOUT = 3
+RTMP_INVALID_URL_REASON = "invalid RTMP URL"
+
+URL_HOST_REGEX = re.compile(r"[A-Za-z][\w+.-]*://(?:[^@/?#]*@)?(\[[^\]/?#]*\]|[^:/?#]*)")
+
+def url_host(url):
+    match = URL_HOST_REGEX.match(url)
+    return match.group(1).lower() if match else ""
+
+class HostState:
+    __slots__ = ("limit", "in_flight", "cooldown_until", "condition", "outcomes", "failures", "circuit", "opened_at")
+
+    def __init__(self):
+        self.limit = float(HOST_INITIAL_CONCURRENCY)
+        self.in_flight = 0
+        self.cooldown_until = 0.0
+        self.condition = asyncio.Condition()
+        # Скользящее окно последних проверок хоста: (отказ, задержка)
+        self.outcomes = deque(maxlen=HOST_CIRCUIT_WINDOW)
+        self.failures = 0
+        self.circuit = CIRCUIT_CLOSED
+        self.opened_at = 0.0
+
+    def health(self):
+        latencies = [latency for _, latency in self.outcomes if latency is not None]
+        return {
+            "samples": len(self.outcomes),
+            "failure_ratio": self.failures / len(self.outcomes) if self.outcomes else 0.0,
+            "avg_latency": sum(latencies) / len(latencies) if latencies else None,
+        }
+
+def retry_after_seconds(value):
+    # Retry-After в виде даты не разбираем: берём паузу по умолчанию
+    try:
+        return min(max(float(value), 0.0), HOST_MAX_COOLDOWN)
+    except (TypeError, ValueError):
+        return HOST_THROTTLE_COOLDOWN
+
+class HostScheduler:
+    """Global in-flight limit plus per-host AIMD limits driven by observed latency and errors.
+
+    Each host also has a circuit breaker over a sliding window of outcomes:
+    once it trips, ``admit`` refuses probes until a cooldown has passed and
+    then lets a single sentinel probe decide whether to close it again.
+
+    Must be created inside the running event loop.
+    """
+
+    def __init__(self, global_limit=MAX_CONCURRENT_CHECKS):
+        self.loop = asyncio.get_running_loop()
+        self.global_slots = asyncio.Semaphore(global_limit)
+        self.hosts = {}
+
+    def state(self, host):
+        state = self.hosts.get(host)
+        if state is None:
+            state = self.hosts[host] = HostState()
+        return state
+
+    @contextlib.asynccontextmanager
+    async def slot(self, host):
+        state = self.state(host)
+        async with state.condition:
+            await state.condition.wait_for(lambda: state.in_flight < int(state.limit))
+            state.in_flight += 1
+        try:
+            delay = state.cooldown_until - self.loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            async with self.global_slots:
+                yield
+        finally:
+            async with state.condition:
+                state.in_flight -= 1
+                state.condition.notify_all()
+
+    def admit(self, host):
+        state = self.state(host)
+        if state.circuit == CIRCUIT_CLOSED:
+            return True
+        if state.circuit == CIRCUIT_OPEN and self.loop.time() >= state.opened_at + HOST_CIRCUIT_COOLDOWN:
+            state.circuit = CIRCUIT_HALF_OPEN
+            log.info("Host %s circuit half-open, sending a sentinel probe.", host)
+            return True
+        return False
+
+    def open_circuit(self, host, state):
+        health = state.health()
+        state.circuit = CIRCUIT_OPEN
+        state.opened_at = self.loop.time()
+        log.warning("Host %s circuit open: %.0f%% of %d recent probes failed, pausing it for %.0fs.",
+                    host, health["failure_ratio"] * 100, health["samples"], HOST_CIRCUIT_COOLDOWN)
+        metrics.count("circuit.opened")
+
+    def abort_sentinel(self, host):
+        # Пробный запрос оборвался исключением или отменой: без этого цепь осталась бы полуоткрытой навсегда
+        state = self.state(host)
+        if state.circuit == CIRCUIT_HALF_OPEN:
+            self.open_circuit(host, state)
+
+    def record_outcome(self, host, failed, latency=None):
+        # Один исход на канал (по итоговому вердикту, а не по каждой попытке), поэтому
+        # несколько мёртвых каналов с повторами не размыкают цепь здорового хоста
+        state = self.state(host)
+        if state.circuit == CIRCUIT_HALF_OPEN:
+            if failed:
+                self.open_circuit(host, state)
+            else:
+                state.circuit = CIRCUIT_CLOSED
+                state.outcomes.clear()
+                state.failures = 0
+                log.info("Host %s circuit closed, sentinel probe succeeded.", host)
+            return
+        if state.circuit == CIRCUIT_OPEN:
+            return  # Ответы проверок, начатых до размыкания
+        if len(state.outcomes) == state.outcomes.maxlen and state.outcomes[0][0]:
+            state.failures -= 1
+        state.outcomes.append((failed, latency))
+        state.failures += failed
+        if len(state.outcomes) >= HOST_CIRCUIT_MIN_SAMPLES \
+                and state.failures >= HOST_CIRCUIT_FAILURE_RATIO * len(state.outcomes):
+            self.open_circuit(host, state)
+
+    def report(self, host, latency=None, status=None, failed=False, retry_after=None):
+        state = self.state(host)
+        throttled = status == 429 or (status == 503 and retry_after is not None)
+        if failed or throttled:
+            state.limit = max(1.0, state.limit / 2)
+            if throttled:
+                state.cooldown_until = self.loop.time() + retry_after_seconds(retry_after)
+        elif latency is not None and latency > HOST_SLOW_LATENCY:
+            state.limit = max(1.0, state.limit - 1)
+        elif latency is not None:
+            state.limit = min(float(HOST_MAX_CONCURRENCY), state.limit + 1 / state.limit)
+
+# Домены блокируются по суффиксу хоста, остальные записи - как подстроки адреса
+BLOCKED_HOST_SUFFIXES = frozenset(entry for entry in BLOCKLIST if "." in entry)
+BLOCKED_KEYWORDS_REGEX = re.compile("|".join(re.escape(entry) for entry in BLOCKLIST if "." not in entry) or r"(?!)")
 
 def is_blocked(url):
-    return any(blocked_domain in url for blocked_domain in BLOCKLIST)
+    host = url_host(url)
+    while host:
+        if host in BLOCKED_HOST_SUFFIXES:
+            return True
+        host = host.partition(".")[2]
+    return BLOCKED_KEYWORDS_REGEX.search(url) is not None
+
+def create_http_session():
+    # Один пул соединений на весь запуск: keep-alive, кэш DNS и лимит соединений на хост
+    connector = aiohttp.TCPConnector(
+        limit=HTTP_POOL_LIMIT,
+        limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+        ttl_dns_cache=DNS_CACHE_TTL,
+        keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+    )
+    return aiohttp.ClientSession(connector=connector)
 
-async def download_m3u(url, attempts=3, timeout=10):
-    async with aiohttp.ClientSession() as session:
-        for attempt in range(1, attempts + 1):
-            try:
-                async with session.get(url, timeout=timeout) as response:
-                    response.raise_for_status()
-                    return await response.text()
-            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
-                print(f"Attempt {attempt}/{attempts} failed for {url}: {e}")
-                if attempt == attempts:
-                    print(f"Error for {url} after {attempts} attempts.")
-                    return None
-            await asyncio.sleep(2)
-
-def extract_url_tvg():
-    return '#EXTM3U url-tvg="https://github.com/DonaIdTrump2024/playlist/releases/download/m3u/myepg.xml.gz"'
+def playlist_cache_path(url):
+    return os.path.join(PLAYLIST_CACHE_DIR, hashlib.sha256(url.encode("utf-8")).hexdigest() + ".json")
+
+def load_cached_playlist(url):
+    try:
+        with open(playlist_cache_path(url), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def save_cached_playlist(url, entry):
+    path = playlist_cache_path(url)
+    os.makedirs(PLAYLIST_CACHE_DIR, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(entry, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def cached_channels(url, cached):
+    if cached.get("parse_version") != PARSE_CACHE_VERSION:
+        with metrics.stage("parse"):
+            cached["channels"] = [channel.to_row() for channel in parse_m3u(cached["body"])]
+        cached["parse_version"] = PARSE_CACHE_VERSION
+        save_cached_playlist(url, cached)
+    return [Channel.from_row(row) for row in cached["channels"]]
+
+async def stream_playlist(url, session, attempts=3, timeout=10):
+    """Yield batches of parsed channels while the playlist body is still arriving.
+
+    Uses the same conditional request and cache as before: on 304 or on a
+    failed download the cached channel list is yielded in one batch.
+    """
+    cached = load_cached_playlist(url)
+    headers = {}
+    if cached and cached.get("etag"):
+        headers["If-None-Match"] = cached["etag"]
+    if cached and cached.get("last_modified"):
+        headers["If-Modified-Since"] = cached["last_modified"]
+
+    started = time.perf_counter()
+    parse_time = 0.0
+    # Сколько каналов уже отдано: при повторе после обрыва они пропускаются
+    delivered = 0
+    for attempt in range(1, attempts + 1):
+        parser = M3UParser()
+        skip = delivered
+        body_parts = []
+        channels = []
+        try:
+            # Без общего лимита времени: пока конвейер занят проверкой, чтение из сокета приостановлено
+            client_timeout = aiohttp.ClientTimeout(sock_connect=timeout, sock_read=timeout)
+            async with session.get(url, headers=headers, timeout=client_timeout) as response:
+                if response.status == 304 and cached:
+                    log.info("Playlist %s not modified, using cached copy.", url)
+                    metrics.count("playlists.not_modified")
+                    yield cached_channels(url, cached)
+                    return
+                response.raise_for_status()
+                etag = response.headers.get("ETag")
+                last_modified = response.headers.get("Last-Modified")
+                cacheable = bool(etag or last_modified)
+                # Кодировку по телу при потоковом чтении не угадать: без charset плейлист считается UTF-8
+                decoder = codecs.getincrementaldecoder(response.charset or "utf-8")("replace")
+                tail = ""
+                final = False
+                chunks = response.content.iter_chunked(PIPELINE_CHUNK_SIZE)
+                while not final:
+                    chunk = await anext(chunks, None)
+                    final = chunk is None
+                    text = decoder.decode(chunk or b"", final)
+                    metrics.count("download.bytes", len(chunk or b""))
+                    if cacheable:
+                        body_parts.append(text)
+                    lines = (tail + text).splitlines()
+                    # Последняя строка может быть оборвана на границе куска - ждём её продолжения
+                    tail = lines.pop() if lines and not final and text[-1:] not in ("\n", "\r") else ""
+                    parse_started = time.perf_counter()
+                    batch = parser.feed(lines)
+                    parse_time += time.perf_counter() - parse_started
+                    if cacheable:
+                        channels.extend(batch)
+                    if skip:
+                        skipped = min(skip, len(batch))
+                        batch = batch[skipped:]
+                        skip -= skipped
+                    if batch:
+                        delivered += len(batch)
+                        yield batch
+            break
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            log.debug("Attempt %d/%d failed for %s: %s", attempt, attempts, url, e)
+            metrics.failure("download", type(e).__name__)
+            if attempt == attempts:
+                log.warning("Error for %s after %d attempts.", url, attempts)
+                if cached and not delivered:
+                    log.warning("Using stale cached copy of %s.", url)
+                    metrics.count("playlists.stale")
+                    yield cached_channels(url, cached)
+                else:
+                    metrics.count("playlists.failed")
+                return
+        await asyncio.sleep(2)
+
+    metrics.add_time("download", time.perf_counter() - started)
+    metrics.add_time("parse", parse_time)
+    metrics.count("playlists.downloaded")
+    metrics.count("parse.channels", delivered)
+    if cacheable:
+        save_cached_playlist(url, {
+            "etag": etag,
+            "last_modified": last_modified,
+            "body": "".join(body_parts),
+            "parse_version": PARSE_CACHE_VERSION,
+            "channels": [channel.to_row() for channel in channels],
+        })
+
+def extract_url_tvg(epg_url=EPG_RELEASE_URL):
+    return f'#EXTM3U url-tvg="{epg_url}"'
+
+CATEGORY_GROUPS = {
+    "Кино и Сериалы": ["Кинозал", "Русский кинозал", "Кинозалы", "Кино и сериалы","Премьеры,хиты", "Фильмы,сериалы", "Viju", "KINO+"],
+    "Эфирные": ["Общественные", "Новостные", "Новости", "Информационные","Федеральные плюс","НТВ"],
+    "США": ["NEWS","UNITED STATES","Live"],
+    "Спортивные": ["Наш спорт","SPORTS","NHL","PPV","NBA", "SPORT 🏆", "SPORT 🏆 VPN"],
+    "Хобби и увлечения": ["Досуг"],
+    "Познавательные": ["ПОЗНАВАТЕЛЬНЫЕ"],
+    "Региональные": ["Региoнальные"],
+    "Музыкальные": ["МУЗИКА"],
+    "Религиозные": ["Христианские"],
+}
+
+# Обратная таблица строится один раз при загрузке: категория -> нормализованное имя
+CATEGORY_ALIASES = {
+    alias: category
+    for category, aliases in CATEGORY_GROUPS.items()
+    for alias in aliases
+}
 
 def normalize_category(category):
-    if category in ["Кинозал", "Русский кинозал", "Кинозалы", "Кино и сериалы","Премьеры,хиты", "Фильмы,сериалы", "Viju", "KINO+"]:
-        return "Кино и Сериалы"
-    if category in ["Общественные", "Новостные", "Новости", "Информационные","Федеральные плюс","НТВ"]:
-        return "Эфирные"
-    if category in ["NEWS","UNITED STATES","Live"]:
-        return "США"
-    if category in ["Наш спорт","SPORTS","NHL","PPV","NBA", "SPORT 🏆", "SPORT 🏆 VPN"]:
-        return "Спортивные"
-    if category in ["Досуг"]:
-        return "Хобби и увлечения"
-    if category in ["ПОЗНАВАТЕЛЬНЫЕ"]:
-        return "Познавательные"
-    if category in ["Региoнальные"]:
-        return "Региональные"
-    if category in ["МУЗИКА"]:
-        return "Музыкальные"
-    if category in ["Христианские"]:
-        return "Религиозные"
-    return category
-
-def check_streamlink(url):
+    return CATEGORY_ALIASES.get(category, category)
+
+def streamlink_worker(conn):
+    conn.send("ready")
+    while True:
+        try:
+            url = conn.recv()
+        except EOFError:
+            return
+        if url is None:
+            return
+        try:
+            conn.send((bool(streamlink.streams(url)), None))
+        except Exception as e:
+            conn.send((False, str(e)))
+
+class StreamlinkPool:
+    """Fixed-size pool of Streamlink worker processes with a shared time budget.
+
+    A worker that misses its deadline is killed and replaced, so hung
+    Streamlink calls never pile up threads in the default executor.
+    """
+
+    def __init__(self, size=STREAMLINK_WORKERS, total_budget=STREAMLINK_TOTAL_BUDGET):
+        self.size = size
+        self.total_budget = total_budget
+        self.context = multiprocessing.get_context("spawn")
+        self.idle = asyncio.Queue()
+        self.workers = set()
+        self.starting = set()
+        self.deadline = None
+
+    def spawn(self):
+        task = asyncio.create_task(self.start_worker())
+        self.starting.add(task)
+        task.add_done_callback(self.starting.discard)
+
+    async def start_worker(self):
+        parent_conn, child_conn = self.context.Pipe()
+        process = self.context.Process(target=streamlink_worker, args=(child_conn,), daemon=True)
+        process.start()
+        child_conn.close()
+        worker = (process, parent_conn)
+        self.workers.add(worker)
+        try:
+            ready = await asyncio.to_thread(parent_conn.poll, STREAMLINK_STARTUP_TIMEOUT)
+            if ready:
+                parent_conn.recv()
+        except (OSError, EOFError):
+            ready = False
+        if ready:
+            self.idle.put_nowait(worker)
+        else:
+            log.warning("Streamlink worker failed to start")
+            metrics.count("streamlink.start_failed")
+            self.kill(worker)
+
+    def kill(self, worker):
+        process, conn = worker
+        self.workers.discard(worker)
+        process.kill()
+        process.join(1)
+        conn.close()
+
+    async def check(self, url, timeout=STREAMLINK_TIMEOUT):
+        loop = asyncio.get_running_loop()
+        if self.deadline is None:
+            self.deadline = loop.time() + self.total_budget
+            for _ in range(self.size):
+                self.spawn()
+
+        remaining = self.deadline - loop.time()
+        if remaining <= 0:
+            log.debug("Streamlink budget exhausted, skipping %s", url)
+            metrics.count("streamlink.budget_exhausted")
+            return False
+        try:
+            worker = await asyncio.wait_for(self.idle.get(), remaining)
+        except asyncio.TimeoutError:
+            log.debug("Streamlink budget exhausted while waiting for a worker, skipping %s", url)
+            metrics.count("streamlink.budget_exhausted")
+            return False
+
+        process, conn = worker
+        limit = max(0, min(timeout, self.deadline - loop.time()))
+        try:
+            conn.send(url)
+            if await asyncio.to_thread(conn.poll, limit):
+                ok, error = conn.recv()
+            else:
+                log.debug("Streamlink check for %s timed out", url)
+                metrics.count("streamlink.timeout")
+                self.kill(worker)
+                self.spawn()
+                return False
+        except (OSError, EOFError) as e:
+            log.warning("Streamlink worker crashed while checking %s: %s", url, e)
+            metrics.count("streamlink.crashed")
+            self.kill(worker)
+            self.spawn()
+            return False
+
+        self.idle.put_nowait(worker)
+        if error:
+            log.debug("Streamlink error for %s: %s", url, error)
+            metrics.count("streamlink.error")
+        elif ok:
+            log.debug("Streamlink detected a valid stream for %s", url)
+        return ok
+
+    async def close(self):
+        for task in list(self.starting):
+            task.cancel()
+        await asyncio.gather(*self.starting, return_exceptions=True)
+        for worker in list(self.workers):
+            process, conn = worker
+            try:
+                conn.send(None)
+            except OSError:
+                pass
+            await asyncio.to_thread(process.join, 1)
+            self.kill(worker)
+
+async def check_streamlink_with_timeout(url, timeout=STREAMLINK_TIMEOUT, pool=None):
+    if pool is not None:
+        return await pool.check(url, timeout)
+    pool = StreamlinkPool(size=1)
     try:
-        streams = streamlink.streams(url)
-        if streams:
-            print(f"Streamlink detected a valid stream for {url}")
-            return True
-    except Exception as e:
-        print(f"Streamlink error for {url}: {e}")
+        return await pool.check(url, timeout)
+    finally:
+        await pool.close()
+
+class ProbeBudget:
+    """Bytes and seconds one channel may spend on deep probes, shared by all of its attempts."""
+
+    __slots__ = ("remaining", "deadline")
+
+    def __init__(self, limit=PROBE_BYTE_BUDGET, seconds=PROBE_TIME_BUDGET):
+        self.remaining = limit
+        self.deadline = asyncio.get_running_loop().time() + seconds
+
+    def time_left(self):
+        return self.deadline - asyncio.get_running_loop().time()
+
+    async def read(self, response, limit=None):
+        limit = self.remaining if limit is None else min(limit, self.remaining)
+        chunks = []
+        size = 0
+        while size < limit:
+            chunk = await response.content.read(limit - size)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            size += len(chunk)
+        self.remaining -= size
+        return b"".join(chunks)
+
+def looks_like_media(data):
+    if data[:1] == b"\x47" and (len(data) < 189 or data[188:189] == b"\x47"):
+        return True  # MPEG-TS
+    if data[4:8] in (b"ftyp", b"styp", b"moof", b"sidx"):
+        return True  # fMP4 / CMAF
+    if data[:3] == b"ID3" or data[:2] in (b"\xff\xf1", b"\xff\xf9"):
+        return True  # ID3 tag or ADTS AAC
     return False
 
-async def check_streamlink_with_timeout(url, timeout=3):
+def pick_variant(playlist, base_url):
+    # Берём вариант с наименьшим битрейтом: дешевле всего скачать и почти всегда доступен
+    best = None
+    lines = playlist.splitlines()
+    for index, line in enumerate(lines):
+        if not line.startswith("#EXT-X-STREAM-INF"):
+            continue
+        match = re.search(r"BANDWIDTH=(\d+)", line)
+        bandwidth = int(match.group(1)) if match else 0
+        uri = next((candidate.strip() for candidate in lines[index + 1:] if candidate.strip() and not candidate.startswith("#")), None)
+        if uri and (best is None or bandwidth < best[0]):
+            best = (bandwidth, uri)
+    return urljoin(base_url, best[1]) if best else None
+
+def pick_segment(playlist, base_url):
+    # В живом плейлисте последний сегмент самый свежий и дольше всех останется на сервере
+    segments = [line.strip() for line in playlist.splitlines() if line.strip() and not line.startswith("#")]
+    return urljoin(base_url, segments[-1]) if segments else None
+
+async def measure_media(response, budget, started, loop):
+    first_chunk = await response.content.readany()
+    ttfb = loop.time() - started
+    budget.remaining -= len(first_chunk)
+    rest = await budget.read(response, PROBE_SEGMENT_BYTES - len(first_chunk))
+    elapsed = loop.time() - started - ttfb
+    data = first_chunk + rest
+    throughput = len(rest) / elapsed if rest and elapsed > 0 else None
+    response.close()
+    return data, ttfb, throughput
+
+async def deep_probe(session, url, headers, latency_callback=None, budget=None):
+    loop = asyncio.get_running_loop()
+    if budget is None:
+        budget = ProbeBudget()
+    started = loop.time()
+    async with session.get(url, headers=headers) as response:
+        latency = loop.time() - started
+        if latency_callback:
+            latency_callback(latency, response.status, response.headers.get("Retry-After"))
+        if response.status not in (200, 206):
+            return StreamVerdict(False, latency, f"HTTP {response.status}")
+        content_type = response.headers.get("Content-Type", "").lower()
+        if not (url.endswith(".m3u8") or "mpegurl" in content_type):
+            data, ttfb, throughput = await measure_media(response, budget, started, loop)
+            if looks_like_media(data):
+                return StreamVerdict(True, latency, None, ttfb, throughput)
+            return StreamVerdict(False, latency, "unrecognized media content")
+        playlist = (await budget.read(response)).decode("utf-8", "replace")
+        playlist_url = str(response.url)
+
+    if not playlist.startswith("#EXTM3U"):
+        return StreamVerdict(False, latency, "invalid m3u8 playlist")
+
+    variant_url = pick_variant(playlist, playlist_url)
+    if variant_url:
+        async with session.get(variant_url, headers=headers) as response:
+            if response.status != 200:
+                return StreamVerdict(False, latency, f"hls: variant HTTP {response.status}")
+            playlist = (await budget.read(response)).decode("utf-8", "replace")
+            playlist_url = str(response.url)
+        if not playlist.startswith("#EXTM3U"):
+            return StreamVerdict(False, latency, "hls: invalid variant playlist")
+
+    segment_url = pick_segment(playlist, playlist_url)
+    if segment_url is None:
+        return StreamVerdict(False, latency, "hls: no segments in playlist")
+
+    segment_headers = dict(headers, Range=f"bytes=0-{PROBE_SEGMENT_BYTES - 1}")
+    segment_started = loop.time()
+    async with session.get(segment_url, headers=segment_headers) as response:
+        if response.status not in (200, 206):
+            return StreamVerdict(False, latency, f"hls: segment HTTP {response.status}")
+        data, ttfb, throughput = await measure_media(response, budget, segment_started, loop)
+
+    # Зашифрованные сегменты (EXT-X-KEY) выглядят как случайные байты
+    if looks_like_media(data) or (data and "#EXT-X-KEY" in playlist):
+        return StreamVerdict(True, latency, None, ttfb, throughput)
+    return StreamVerdict(False, latency, "hls: unrecognized segment content")
+
+async def is_stream_working(url, user_agent=None, referer=None, http_origin=None, attempts=3, session=None, scheduler=None, fallback=None, probe_mode="basic"):
+    verdict = await check_stream(url, user_agent, referer, http_origin, attempts, session, scheduler, fallback, probe_mode)
+    return verdict.ok
+
+async def basic_probe(session, url, headers, scheduler, host, attempt, attempts):
+    loop = asyncio.get_running_loop()
+    started = loop.time()
     try:
-        result = await asyncio.wait_for(asyncio.to_thread(streamlink.streams, url), timeout)
-        if result:
-            print(f"Streamlink detected a valid stream for {url}")
-            return True
+        async with session.get(url, headers=headers, timeout=5) as response:
+            latency = loop.time() - started
+            scheduler.report(host, latency=latency, status=response.status, retry_after=response.headers.get("Retry-After"))
+            content_type = response.headers.get("Content-Type", "").lower()
+            reason = f"HTTP {response.status}"
+            
+            if response.status in [200, 301, 302, 307]:
+                reason = f"unexpected content ({content_type})"
+                if url.endswith(".m3u8") or "application/vnd.apple.mpegurl" in content_type:
+                    content = await response.text()
+                    if content.startswith("#EXTM3U"):
+                        log.debug("Attempt %d/%d for %s - Valid m3u8 playlist detected.", attempt, attempts, url)
+                        return StreamVerdict(True, latency, None)
+                    reason = "invalid m3u8 playlist"
+                
+                if "video" in content_type or content_type in ["application/octet-stream", "application/x-mpegurl"]:
+                    log.debug("Attempt %d/%d for %s - Checking MPEG stream.", attempt, attempts, url)
+                    
+                    try:
+                        content_preview = await response.content.read(1024)
+                        # Поток бесконечный: соединение закрываем сразу, не дочитывая тело
+                        response.close()
+                        if b"#EXTM3U" in content_preview or b"#EXTINF" in content_preview:
+                            log.debug("Attempt %d/%d for %s - Detected playlist markers in preview.", attempt, attempts, url)
+                            return StreamVerdict(True, latency, None)
+                        elif len(content_preview) > 0:
+                            log.debug("Attempt %d/%d for %s - Valid MPEG stream detected based on content length.", attempt, attempts, url)
+                            return StreamVerdict(True, latency, None)
+                        else:
+                            log.debug("Attempt %d/%d for %s - Empty response content.", attempt, attempts, url)
+                            reason = "empty response content"
+                    except Exception as e:
+                        log.debug("Attempt %d/%d for %s - Error reading stream content: %s", attempt, attempts, url, e)
+                        reason = f"read error: {type(e).__name__}"
+
+                if content_type == "":
+                    log.debug("Attempt %d/%d for %s - Empty Content-Type, assuming stream might be working.", attempt, attempts, url)
+                    return StreamVerdict(True, latency, None)
+
+            return StreamVerdict(False, latency, reason)
+
     except asyncio.TimeoutError:
-        print(f"Streamlink check for {url} timed out")
-    except Exception as e:
-        print(f"Streamlink error for {url}: {e}")
-    return False
+        log.debug("Attempt %d/%d for %s - Error: timeout", attempt, attempts, url)
+        scheduler.report(host, failed=True)
+        return StreamVerdict(False, None, "timeout")
+    except aiohttp.ClientError as e:
+        log.debug("Attempt %d/%d for %s - Error: %s", attempt, attempts, url, e)
+        scheduler.report(host, failed=True)
+        return StreamVerdict(False, None, f"client error: {type(e).__name__}")
+
+async def deep_probe_with_budget(session, url, headers, scheduler, host, attempt, attempts, budget=None):
+    if budget is None:
+        budget = ProbeBudget()
+    # Повторные попытки тратят остаток того же бюджета, а не получают новый
+    if budget.remaining <= 0 or budget.time_left() <= 0:
+        log.debug("Attempt %d/%d for %s - Deep probe budget exhausted.", attempt, attempts, url)
+        return StreamVerdict(False, None, PROBE_BUDGET_REASON)
+    try:
+        verdict = await asyncio.wait_for(
+            deep_probe(session, url, headers, lambda latency, status, retry_after: scheduler.report(host, latency, status, retry_after=retry_after), budget),
+            budget.time_left(),
+        )
+    except asyncio.TimeoutError:
+        scheduler.report(host, failed=True)
+        verdict = StreamVerdict(False, None, "timeout")
+    except aiohttp.ClientError as e:
+        scheduler.report(host, failed=True)
+        verdict = StreamVerdict(False, None, f"client error: {type(e).__name__}")
+
+    if verdict.ok:
+        log.debug("Attempt %d/%d for %s - Deep probe passed (TTFB %.2fs).", attempt, attempts, url, verdict.ttfb)
+    else:
+        log.debug("Attempt %d/%d for %s - Deep probe failed: %s", attempt, attempts, url, verdict.reason)
+    return verdict
+
+async def check_stream(url, user_agent=None, referer=None, http_origin=None, attempts=3, session=None, scheduler=None, fallback=None, probe_mode="basic"):
+    if session is None:
+        async with create_http_session() as session:
+            return await check_stream(url, user_agent, referer, http_origin, attempts, session, scheduler, fallback, probe_mode)
+    if scheduler is None:
+        scheduler = HostScheduler()
 
-async def is_stream_working(url, user_agent=None, referer=None, http_origin=None, attempts=3):
     headers = {}
     if user_agent:
         headers['User-Agent'] = user_agent
@@ -83,67 +728,114 @@ async def is_stream_working(url, user_agent=None, referer=None, http_origin=None
         headers['Origin'] = http_origin
 
     if is_blocked(url):
-        print(f"URL {url} is blocked")
-        return False
-
-    async with semaphore:
-        if url.startswith("rtmp://"):
-            return await check_rtmp_stream(url, attempts)
-
-        async with aiohttp.ClientSession() as session:
-            for attempt in range(1, attempts + 1):
-                try:
-                    async with session.get(url, headers=headers, timeout=5) as response:
-                        content_type = response.headers.get("Content-Type", "").lower()
-                        
-                        if response.status in [200, 301, 302, 307]:
-                            if url.endswith(".m3u8") or "application/vnd.apple.mpegurl" in content_type:
-                                content = await response.text()
-                                if content.startswith("#EXTM3U"):
-                                    print(f"Attempt {attempt}/{attempts} for {url} - Valid m3u8 playlist detected.")
-                                    return True
-                            
-                            if "video" in content_type or content_type in ["application/octet-stream", "application/x-mpegurl"]:
-                                print(f"Attempt {attempt}/{attempts} for {url} - Checking MPEG stream.")
-                                
-                                try:
-                                    content_preview = await response.content.read(1024)
-                                    if b"#EXTM3U" in content_preview or b"#EXTINF" in content_preview:
-                                        print(f"Attempt {attempt}/{attempts} for {url} - Detected playlist markers in preview.")
-                                        return True
-                                    elif len(content_preview) > 0:
-                                        print(f"Attempt {attempt}/{attempts} for {url} - Valid MPEG stream detected based on content length.")
-                                        return True
-                                    else:
-                                        print(f"Attempt {attempt}/{attempts} for {url} - Empty response content.")
-                                except Exception as e:
-                                    print(f"Attempt {attempt}/{attempts} for {url} - Error reading stream content: {e}")
-
-                            if content_type == "":
-                                print(f"Attempt {attempt}/{attempts} for {url} - Empty Content-Type, assuming stream might be working.")
-                                return True
-
-                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
-                    print(f"Attempt {attempt}/{attempts} for {url} - Error: {e}")
-
-    print(f"Stream {url} failed after {attempts} attempts, falling back to Streamlink.")
-    
-    return await check_streamlink_with_timeout(url)
-
-async def check_rtmp_stream(url, attempts):
-    cleaned_url = url.replace("rtmp://", "rtmp://")
-    host = cleaned_url.split("/")[2].split(":")[0]
-    port = int(cleaned_url.split("/")[2].split(":")[1]) if ":" in cleaned_url.split("/")[2] else 1935
-
-    loop = asyncio.get_event_loop()
-    for attempt in range(1, attempts + 1):
-        try:
-            await loop.run_in_executor(None, socket.create_connection, (host, port), 5)
-            print(f"Attempt {attempt}/{attempts} for {url} - Working (RTMP/TCP)")
-            return True
-        except (socket.timeout, ConnectionRefusedError, OSError):
-            print(f"Attempt {attempt}/{attempts} for {url} - Failed (RTMP/TCP)")
-    return False
+        log.debug("URL %s is blocked", url)
+        return StreamVerdict(False, None, "blocked")
+
+    host = url_host(url)
+    is_rtmp = url.startswith("rtmp://")
+    if is_rtmp:
+        probe = rtmp_probe
+    else:
+        probe = deep_probe_with_budget if probe_mode == "deep" else basic_probe
+    reason = None
+    async with scheduler.slot(host):
+        if probe is deep_probe_with_budget:
+            # Бюджет на канал, а не на попытку; отсчёт времени - с получения слота
+            probe = functools.partial(probe, budget=ProbeBudget())
+        if not scheduler.admit(host):
+            log.debug("Host %s circuit is open, skipping %s", host, url)
+            metrics.count("circuit.fast_fail")
+            reason = CIRCUIT_OPEN_REASON
+        else:
+            # В полуоткрытом состоянии admit пропускает ровно один канал - пробный
+            sentinel = scheduler.state(host).circuit == CIRCUIT_HALF_OPEN
+            unreachable = False
+            try:
+                for attempt in range(1, attempts + 1):
+                    if attempt > 1 and scheduler.state(host).circuit == CIRCUIT_OPEN:
+                        reason = CIRCUIT_OPEN_REASON
+                        break
+                    verdict = await probe(session, url, headers, scheduler, host, attempt, attempts)
+                    metrics.probe(host, verdict.latency, failed=not verdict.ok)
+                    if verdict.ok:
+                        break
+                    reason = verdict.reason
+                    if reason not in (PROBE_BUDGET_REASON, RTMP_INVALID_URL_REASON):
+                        # Отказ хоста - это таймаут или ошибка соединения; ответ с ошибкой касается только канала
+                        unreachable = verdict.latency is None
+            except BaseException:
+                if sentinel:
+                    scheduler.abort_sentinel(host)
+                raise
+            if reason != CIRCUIT_OPEN_REASON:
+                scheduler.record_outcome(host, failed=not verdict.ok and unreachable, latency=verdict.latency)
+            if verdict.ok:
+                return verdict
+
+    # Плейлист получен, но варианты или сегменты мертвы - Streamlink здесь ничего не добавит.
+    # RTMP-сервер без рукопожатия Streamlink тоже не оживит, как и хост с разомкнутой цепью
+    if is_rtmp or reason == CIRCUIT_OPEN_REASON or (reason and reason.startswith("hls:")):
+        log.debug("Stream %s failed after %d attempts (%s).", url, attempts, reason)
+        return StreamVerdict(False, None, reason)
+
+    log.debug("Stream %s failed after %d attempts, falling back to Streamlink.", url, attempts)
+
+    with metrics.stage("streamlink"):
+        ok = await check_streamlink_with_timeout(url, pool=fallback)
+    metrics.count("streamlink.ok" if ok else "streamlink.failed")
+    if ok:
+        return StreamVerdict(True, None, None)
+    return StreamVerdict(False, None, reason)
+
+async def rtmp_handshake(host, port):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        # C0 - версия протокола, C1 - время, четыре нулевых байта и случайное заполнение
+        c1 = int(time.time()).to_bytes(4, "big") + bytes(4) + os.urandom(RTMP_HANDSHAKE_SIZE - 8)
+        writer.write(bytes([RTMP_VERSION]) + c1)
+        await writer.drain()
+        s0 = await reader.readexactly(1)
+        if s0[0] != RTMP_VERSION:
+            return f"unsupported RTMP version {s0[0]}"
+        await reader.readexactly(RTMP_HANDSHAKE_SIZE)
+        return None
+    finally:
+        writer.close()
+        with contextlib.suppress(OSError):
+            await writer.wait_closed()
+
+async def check_rtmp_stream(url, timeout=RTMP_HANDSHAKE_TIMEOUT):
+    try:
+        parts = urlsplit(url)
+        host, port = parts.hostname, parts.port or RTMP_DEFAULT_PORT
+    except ValueError:
+        return StreamVerdict(False, None, RTMP_INVALID_URL_REASON)
+    if not host:
+        return StreamVerdict(False, None, RTMP_INVALID_URL_REASON)
+
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    try:
+        error = await asyncio.wait_for(rtmp_handshake(host, port), timeout)
+    except asyncio.TimeoutError:
+        return StreamVerdict(False, None, "RTMP handshake timeout")
+    except asyncio.IncompleteReadError:
+        return StreamVerdict(False, None, "RTMP handshake interrupted")
+    except OSError as e:
+        return StreamVerdict(False, None, f"RTMP connect failed: {type(e).__name__}")
+    latency = loop.time() - started
+    if error:
+        return StreamVerdict(False, latency, error)
+    return StreamVerdict(True, latency, None)
+
+async def rtmp_probe(session, url, headers, scheduler, host, attempt, attempts):
+    verdict = await check_rtmp_stream(url)
+    scheduler.report(host, latency=verdict.latency, failed=verdict.latency is None)
+    if verdict.ok:
+        log.debug("Attempt %d/%d for %s - RTMP handshake completed in %.2fs.", attempt, attempts, url, verdict.latency)
+    else:
+        log.debug("Attempt %d/%d for %s - RTMP check failed: %s", attempt, attempts, url, verdict.reason)
+    return verdict
 
 UNWANTED_TERMS = [
     "FHD", "UA", "720х576", "1280х720", "r1", "r2", "r3", "hd1",
@@ -153,203 +845,802 @@ UNWANTED_TERMS = [
 UNWANTED_REGEX = re.compile(
     r"|".join([re.escape(term) for term in UNWANTED_TERMS]), re.IGNORECASE
 )
+PARENTHESES_REGEX = re.compile(r"\s*\([^)]*\)")
 
+@functools.lru_cache(maxsize=65536)
 def clean_channel_name(name):
-    name = re.sub(r"\s*\([^)]*\)", "", name)
+    name = PARENTHESES_REGEX.sub("", name)
     name = UNWANTED_REGEX.sub("", name)
     return name.strip()
 
-def extract_channel_name(extinf_line):
-    name = extinf_line.split(",", 1)[1].strip()
-    return clean_channel_name(name)
+EXCLUDED_GROUPS = [
+    "Взрослые [ВХОД СТРОГО 18+]",
+    "ИНФО",
+    "Региональные",
+    "Региoнальные",
+    "Казахстан",
+    "Беларусь",
+    "ОБЩИЕ",
+    "Кухня",
+    "KIDS",
+    "ДІТИ",
+    "РАДІО",
+    "РЕЛАКС",
+    "SPANISH",
+    "Детские",
+    "Fashion",
+    "Религиозные",
+    "Христианские",
+    "DOCUMENTARY",
+    "MOVIES",
+    "ENTERTAINMENT",
+    "EVENTS",
+]
 
-def parse_m3u(m3u_data):
-    channels = []
-    lines = m3u_data.splitlines()
-    current_channel = None
-    current_group = None
-    user_agent = None
-    referrer = None
-    http_origin = None
-
-    for line in lines:
-        if line.startswith("#EXTINF"):
-            excluded_groups = [
-                'group-title="Взрослые [ВХОД СТРОГО 18+]"',
-                'group-title="ИНФО"',
-                'group-title="Региональные"',
-                'group-title="Региoнальные"',
-                'group-title="Казахстан"',
-                'group-title="Беларусь"',
-                'group-title="ОБЩИЕ"',
-                'group-title="Кухня"',
-                'group-title="KIDS"',
-                'group-title="ДІТИ"',
-                'group-title="РАДІО"',
-                'group-title="РЕЛАКС"',
-                'group-title="SPANISH"',
-                'group-title="Детские"',
-                'group-title="Fashion"',
-                'Эстония', "Литва", "Латвия", "Грузия", "Армения", "Азербайджан", "МОЛДОВА",
-                'group-title="Религиозные"',
-                'group-title="Христианские"',
-                'group-title="DOCUMENTARY"',
-                'group-title="MOVIES"',
-                'group-title="ENTERTAINMENT"',
-                'group-title="EVENTS"',
-                #'[нестабильные]',
-                'magenta',
-                'РЕЛАКС- расслабление',
-                'Криминальная Россия',
-                'Следствие вели',
-                'Tom & Jerry',
-                'Симпсоны',
-                'CHILDREN',
-                'AMAZON',
-                'ТВA'
-            ]
-            if any(excluded_group in line for excluded_group in excluded_groups):
-                current_channel = None
-                continue
-
-            if 'group-title="' in line:
-                group_title = line.split('group-title="')[1].split('"')[0]
-                normalized_category = normalize_category(group_title)
-                line = line.replace(f'group-title="{group_title}"', f'group-title="{normalized_category}"')
-            elif current_group:
-                normalized_category = normalize_category(current_group)
-                info_parts = line.split(',', 1)
-                info_part = info_parts[0]
-                line = f'{info_part} group-title="{normalized_category}",{info_parts[1]}'
-            else:
-                normalized_category = "Не сортировано"
-                info_parts = line.split(',', 1)
-                info_part = info_parts[0]
-                line = f'{info_part} group-title="{normalized_category}",{info_parts[1]}'
-
-            match = re.search(r'tvg-id="?([^"\s]+)"?', line)
-            tvg_id = match.group(1) if match else None
-            cleaned_name = clean_channel_name(line.split(",", 1)[1])
-            line = f"{line.split(',')[0]},{cleaned_name}"
-            current_channel = {"info": line, "stream": None, "tvg-id": tvg_id, "category": normalized_category}
-
-        elif line.startswith("#EXTGRP:"):
-            current_group = line.replace("#EXTGRP:", "").strip()
-
-        elif line.startswith("#EXTVLCOPT:http-user-agent="):
-            user_agent = line.split("=")[1].strip()
-
-        elif line.startswith("#EXTVLCOPT:http-referrer="):
-            referrer = line.split("=")[1].strip()
-
-        elif line.startswith("#EXTVLCOPT:http-origin="):
-            http_origin = line.split("=")[1].strip()
-
-        elif line and current_channel:
-            current_channel["stream"] = line
-            current_channel["user_agent"] = user_agent
-            current_channel["referrer"] = referrer
-            current_channel["http_origin"] = http_origin
-            channels.append(current_channel)
-            current_channel = None
-            user_agent = None
-            referrer = None
-            http_origin = None
-            current_group = None
+# Подстроки, при наличии которых в строке #EXTINF канал пропускается
+EXCLUDED_TERMS = [
+    'Эстония', "Литва", "Латвия", "Грузия", "Армения", "Азербайджан", "МОЛДОВА",
+    #'[нестабильные]',
+    'magenta',
+    'РЕЛАКС- расслабление',
+    'Криминальная Россия',
+    'Следствие вели',
+    'Tom & Jerry',
+    'Симпсоны',
+    'CHILDREN',
+    'AMAZON',
+    'ТВA'
+]
 
-    return channels
+EXCLUDED_GROUP_SET = frozenset(EXCLUDED_GROUPS)
+EXCLUDED_TERMS_REGEX = re.compile("|".join(re.escape(term) for term in EXCLUDED_TERMS))
+
+# #EXTINF:<длительность> <атрибуты>,<название>; запятые внутри кавычек не считаются разделителем
+EXTINF_REGEX = re.compile(r'(#EXTINF:[^",]*(?:"[^"]*"[^",]*)*),(.*)')
+EXTINF_ATTR_REGEX = re.compile(r'([\w-]+)="([^"]*)"')
+TVG_ID_REGEX = re.compile(r'tvg-id=([^"\s]+)')
+
+EXTVLCOPT_USER_AGENT = "#EXTVLCOPT:http-user-agent="
+EXTVLCOPT_REFERRER = "#EXTVLCOPT:http-referrer="
+EXTVLCOPT_ORIGIN = "#EXTVLCOPT:http-origin="
+
+def intern_optional(value):
+    return sys.intern(value) if value else value
+
+class Channel:
+    """Playlist entry with the #EXTINF line kept as parsed fields.
+
+    ``head`` is the #EXTINF attribute section without the ``#EXTINF:``
+    prefix and without group-title; the category is stored separately.
+    Values repeated across thousands of entries (category, headers) are
+    interned, so merged source lists share one copy of each string.
+    """
+
+    __slots__ = ("head", "name", "tvg_id", "category", "stream", "user_agent", "referrer", "http_origin")
+
+    def __init__(self, head, name, tvg_id, category, stream, user_agent=None, referrer=None, http_origin=None):
+        self.head = head
+        self.name = name
+        self.tvg_id = tvg_id
+        self.category = sys.intern(category)
+        self.stream = stream
+        self.user_agent = intern_optional(user_agent)
+        self.referrer = intern_optional(referrer)
+        self.http_origin = intern_optional(http_origin)
+
+    @property
+    def info(self):
+        return f'#EXTINF:{self.head} group-title="{self.category}",{self.name}'
+
+    def to_row(self):
+        return [getattr(self, field) for field in self.__slots__]
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(*row)
+
+    def __repr__(self):
+        return f"Channel({self.tvg_id!r}, {self.name!r}, {self.stream!r})"
+
+def is_excluded(extinf_line, group_title):
+    return group_title in EXCLUDED_GROUP_SET or EXCLUDED_TERMS_REGEX.search(extinf_line) is not None
+
+class M3UParser:
+    """Incremental M3U parser: ``feed`` takes a batch of lines and returns the channels completed in it.
+
+    The state of an unfinished entry (#EXTINF, #EXTGRP, #EXTVLCOPT lines
+    seen so far) is kept between batches, so a playlist can be parsed
+    while it is still downloading.
+    """
+
+    def __init__(self):
+        self.current_entry = None
+        self.current_group = None
+        self.user_agent = None
+        self.referrer = None
+        self.http_origin = None
+
+    def feed(self, lines):
+        channels = []
+        # Состояние в локальных переменных: внутренний цикл так же быстр, как при разборе целого файла
+        current_entry = self.current_entry
+        current_group = self.current_group
+        user_agent = self.user_agent
+        referrer = self.referrer
+        http_origin = self.http_origin
+
+        for line in lines:
+            if not line.startswith("#"):
+                if line and current_entry:
+                    channels.append(Channel(*current_entry, line, user_agent, referrer, http_origin))
+                    current_entry = None
+                    user_agent = None
+                    referrer = None
+                    http_origin = None
+                    current_group = None
+
+            elif line.startswith("#EXTINF"):
+                current_entry = None
+                match = EXTINF_REGEX.match(line)
+                if match is None:
+                    continue
+                head, name = match.groups()
+                attrs = dict(EXTINF_ATTR_REGEX.findall(head))
+                group_title = attrs.get("group-title")
+
+                if is_excluded(line, group_title):
+                    continue
+
+                # group-title хранится отдельно в category и дописывается в конец строки при выводе
+                if group_title is not None:
+                    normalized_category = normalize_category(group_title)
+                    group_attr = f'group-title="{group_title}"'
+                    head = head.replace(f" {group_attr}", "") if f" {group_attr}" in head else head.replace(group_attr, "")
+                else:
+                    normalized_category = normalize_category(current_group) if current_group else "Не сортировано"
+
+                tvg_id = attrs.get("tvg-id")
+                if tvg_id is None:
+                    tvg_match = TVG_ID_REGEX.search(head)
+                    tvg_id = tvg_match.group(1) if tvg_match else None
+                else:
+                    tvg_id = tvg_id.split(None, 1)[0] if tvg_id[:1].strip() else None
+                current_entry = (head[8:], clean_channel_name(name), tvg_id, normalized_category)
+
+            elif line.startswith("#EXTGRP:"):
+                current_group = line[8:].strip()
+
+            elif line.startswith(EXTVLCOPT_USER_AGENT):
+                user_agent = line[len(EXTVLCOPT_USER_AGENT):].strip()
+
+            elif line.startswith(EXTVLCOPT_REFERRER):
+                referrer = line[len(EXTVLCOPT_REFERRER):].strip()
+
+            elif line.startswith(EXTVLCOPT_ORIGIN):
+                http_origin = line[len(EXTVLCOPT_ORIGIN):].strip()
+
+        self.current_entry = current_entry
+        self.current_group = current_group
+        self.user_agent = user_agent
+        self.referrer = referrer
+        self.http_origin = http_origin
+        return channels
 
-async def check_channels(channels):
-    tasks = []
-    for channel in channels:
-        task = is_stream_working(
-            channel["stream"],
-            user_agent=channel.get("user_agent"),
-            referer=channel.get("referrer"),
-            http_origin=channel.get("http_origin")
+def parse_m3u(m3u_data):
+    return M3UParser().feed(m3u_data.splitlines())
+
+class StreamHealthCache:
+    """Per-URL probe verdicts persisted between runs in SQLite."""
+
+    def __init__(self, path=HEALTH_DB_FILE, ttl=HEALTH_TTL_HOURS * 3600):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.ttl = ttl
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS stream_health ("
+            "url TEXT PRIMARY KEY, ok INTEGER NOT NULL, checked_at REAL NOT NULL, "
+            "latency REAL, reason TEXT, failures INTEGER NOT NULL DEFAULT 0)"
         )
-        tasks.append(task)
-
-    results = await asyncio.gather(*tasks)
-
-    for channel, is_working in zip(channels, results):
-        if is_working:
-            print(f"Channel {channel['tvg-id']} - Stream is working.")
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(stream_health)")}
+        for column, definition in (("ttfb", "REAL"), ("throughput", "REAL"), ("probe_mode", "TEXT NOT NULL DEFAULT 'basic'")):
+            if column not in columns:
+                self.conn.execute(f"ALTER TABLE stream_health ADD COLUMN {column} {definition}")
+
+    def lookup(self):
+        rows = self.conn.execute(
+            "SELECT url, ok, checked_at, latency, reason, failures, ttfb, throughput, probe_mode FROM stream_health"
+        )
+        return {
+            url: {
+                "ok": bool(ok), "checked_at": checked_at, "latency": latency, "reason": reason,
+                "failures": failures, "ttfb": ttfb, "throughput": throughput, "probe_mode": probe_mode,
+            }
+            for url, ok, checked_at, latency, reason, failures, ttfb, throughput, probe_mode in rows
+        }
+
+    def is_fresh(self, entry, now, probe_mode="basic"):
+        # Результат простой проверки не заменяет глубокую
+        if probe_mode == "deep" and entry["probe_mode"] != "deep":
+            return False
+        return entry["ok"] and now - entry["checked_at"] < self.ttl
+
+    def record(self, verdicts, checked_at, probe_mode="basic"):
+        with self.conn:
+            self.conn.executemany(
+                "INSERT INTO stream_health (url, ok, checked_at, latency, reason, failures, ttfb, throughput, probe_mode) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(url) DO UPDATE SET ok = excluded.ok, checked_at = excluded.checked_at, "
+                "latency = excluded.latency, reason = excluded.reason, ttfb = excluded.ttfb, "
+                "throughput = excluded.throughput, probe_mode = excluded.probe_mode, "
+                "failures = CASE WHEN excluded.ok THEN 0 ELSE stream_health.failures + 1 END",
+                [
+                    (url, int(verdict.ok), checked_at, verdict.latency, verdict.reason, 0 if verdict.ok else 1,
+                     verdict.ttfb, verdict.throughput, probe_mode)
+                    for url, verdict in verdicts
+                ],
+            )
+            self.conn.execute(
+                "DELETE FROM stream_health WHERE checked_at < ?",
+                (checked_at - HEALTH_RETENTION_DAYS * 86400,),
+            )
+
+    def close(self):
+        self.conn.close()
+
+def probe_priority(entry):
+    # Сначала новые адреса, затем недавно упавшие, затем устаревшие рабочие
+    if entry is None:
+        return 0
+    if not entry["ok"]:
+        return 1
+    return 2
+
+def validation_shard(conn, probe_mode, streamlink_workers, log_level):
+    setup_logging(log_level)
+    asyncio.run(run_validation_shard(conn, probe_mode, streamlink_workers))
+
+async def run_validation_shard(conn, probe_mode, streamlink_workers):
+    loop = asyncio.get_running_loop()
+    scheduler = HostScheduler()
+    fallback = StreamlinkPool(size=streamlink_workers)
+    stopped = loop.create_future()
+    tasks = set()
+
+    async def probe(session, request_id, url, user_agent, referer, http_origin):
+        try:
+            verdict = await check_stream(url, user_agent, referer, http_origin, session=session,
+                                         scheduler=scheduler, fallback=fallback, probe_mode=probe_mode)
+        except Exception as e:
+            log.exception("Probe of %s failed", url)
+            verdict = StreamVerdict(False, None, type(e).__name__)
+        conn.send(("verdict", request_id, verdict))
+
+    def receive(session):
+        try:
+            while conn.poll():
+                batch = conn.recv()
+                if batch is None:
+                    break
+                for request in batch:
+                    task = loop.create_task(probe(session, *request))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+            else:
+                return
+        except (EOFError, OSError):
+            pass
+        loop.remove_reader(conn.fileno())
+        if not stopped.done():
+            stopped.set_result(None)
+
+    async with create_http_session() as session:
+        loop.add_reader(conn.fileno(), receive, session)
+        try:
+            await stopped
+            await asyncio.gather(*tasks)
+        finally:
+            await fallback.close()
+    conn.send(("metrics", metrics.snapshot()))
+    conn.close()
+
+class ValidationShard:
+    """Parent-side handle of one validation process.
+
+    Requests are batched and sent from a thread, so a full pipe never
+    blocks the event loop that reads verdicts coming back.
+    """
+
+    def __init__(self, context, probe_mode, streamlink_workers):
+        self.loop = asyncio.get_running_loop()
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=validation_shard, args=(child_conn, probe_mode, streamlink_workers, log.getEffectiveLevel())
+        )
+        self.process.start()
+        child_conn.close()
+        self.pending = {}
+        self.next_id = 0
+        self.outbox = []
+        self.flushing = None
+        self.finished = self.loop.create_future()
+        self.loop.add_reader(self.conn.fileno(), self.receive)
+
+    def check(self, channel):
+        future = self.loop.create_future()
+        self.pending[self.next_id] = future
+        self.outbox.append((self.next_id, channel.stream, channel.user_agent, channel.referrer, channel.http_origin))
+        self.next_id += 1
+        if self.flushing is None:
+            self.flushing = self.loop.create_task(self.flush())
+        return future
+
+    async def flush(self):
+        try:
+            while self.outbox:
+                batch, self.outbox = self.outbox, []
+                await asyncio.to_thread(self.conn.send, batch)
+        except OSError:
+            self.fail()
+        finally:
+            self.flushing = None
+
+    def receive(self):
+        try:
+            while self.conn.poll():
+                message = self.conn.recv()
+                if message[0] == "metrics":
+                    metrics.merge(message[1])
+                    continue
+                future = self.pending.pop(message[1], None)
+                if future is not None and not future.done():
+                    future.set_result(message[2])
+        except (EOFError, OSError):
+            self.fail()
+
+    def fail(self):
+        self.loop.remove_reader(self.conn.fileno())
+        if self.pending:
+            log.warning("Validation shard exited with %d streams unchecked", len(self.pending))
+            metrics.count("shard.crashed")
+        for future in self.pending.values():
+            if not future.done():
+                future.set_result(StreamVerdict(False, None, "shard crashed"))
+        self.pending.clear()
+        if not self.finished.done():
+            self.finished.set_result(None)
+
+    async def close(self):
+        if self.flushing is not None:
+            await self.flushing
+        if not self.finished.done():
+            try:
+                await asyncio.to_thread(self.conn.send, None)
+                # Шард досылает метрики и закрывает канал - receive увидит EOF
+                await asyncio.wait_for(asyncio.shield(self.finished), SHARD_SHUTDOWN_TIMEOUT)
+            except (OSError, asyncio.TimeoutError):
+                log.warning("Validation shard did not shut down cleanly")
+                self.fail()
+        await asyncio.to_thread(self.process.join, 1)
+        if self.process.is_alive():
+            self.process.kill()
+            await asyncio.to_thread(self.process.join, 1)
+        self.conn.close()
+
+class ValidationShards:
+    """Stream validation spread over several processes, one event loop each.
+
+    Streams are routed by a hash of their host, so every host is probed by
+    a single shard and its AIMD limits and circuit breaker stay accurate.
+    The health cache and the order of verdicts stay with the caller.
+
+    Must be created inside the running event loop.
+    """
+
+    def __init__(self, count, probe_mode="basic"):
+        context = multiprocessing.get_context("spawn")
+        streamlink_workers = max(1, STREAMLINK_WORKERS // count)
+        self.shards = [ValidationShard(context, probe_mode, streamlink_workers) for _ in range(count)]
+
+    def shard_for(self, url):
+        digest = hashlib.blake2b(url_host(url).encode("utf-8"), digest_size=4).digest()
+        return self.shards[int.from_bytes(digest, "big") % len(self.shards)]
+
+    def check(self, channel):
+        return self.shard_for(channel.stream).check(channel)
+
+    async def close(self):
+        await asyncio.gather(*(shard.close() for shard in self.shards))
+
+async def check_channels(channels, health_cache=None, probe_mode="basic", scheduler=None, shards=VALIDATION_SHARDS):
+    now = time.time()
+    known = health_cache.lookup() if health_cache else {}
+    results = [None] * len(channels)
+    pending = []
+
+    for index, channel in enumerate(channels):
+        entry = known.get(channel.stream)
+        if entry and health_cache.is_fresh(entry, now, probe_mode):
+            results[index] = StreamVerdict(True, entry["latency"], None, entry["ttfb"], entry["throughput"])
         else:
-            print(f"Channel {channel['tvg-id']} - Stream is not working or blocked.")
-
-    return results
+            pending.append((probe_priority(entry), index))
 
-async def merge_m3u_channels_async(*channel_lists):
-    all_channels = []
-    for channel_list in channel_lists:
-        all_channels.extend(channel_list)
+    pending.sort()
+    log.info("Trusting %d recently verified streams, probing %d.", len(channels) - len(pending), len(pending))
+    metrics.count("probe.trusted", len(channels) - len(pending))
+    metrics.count("probe.checked", len(pending))
 
-    valid_channels = []
-    existing_urls = set()
-
-    results = await check_channels(all_channels)
-    for channel, is_working in zip(all_channels, results):
-        stream_url = channel.get("stream")
+    if shards > 1:
+        log.info("Validating in %d processes.", shards)
+        pool = ValidationShards(shards, probe_mode)
+        try:
+            with metrics.stage("probe"):
+                probed = await asyncio.gather(*(pool.check(channels[index]) for _, index in pending))
+        finally:
+            await pool.close()
+    else:
+        if scheduler is None:
+            scheduler = HostScheduler()
+        fallback = StreamlinkPool()
+        async with create_http_session() as session:
+            tasks = []
+            for _, index in pending:
+                channel = channels[index]
+                task = check_stream(
+                    channel.stream,
+                    user_agent=channel.user_agent,
+                    referer=channel.referrer,
+                    http_origin=channel.http_origin,
+                    session=session,
+                    scheduler=scheduler,
+                    fallback=fallback,
+                    probe_mode=probe_mode
+                )
+                tasks.append(task)
 
-        if is_working and stream_url not in existing_urls:
-            valid_channels.append(channel)
-            existing_urls.add(stream_url)
-        elif not is_working:
-            print(f"Channel {channel['tvg-id']} - No working stream found")
+            try:
+                with metrics.stage("probe"):
+                    probed = await asyncio.gather(*tasks)
+            finally:
+                await fallback.close()
+
+    for (_, index), verdict in zip(pending, probed):
+        results[index] = verdict
+
+    if health_cache:
+        health_cache.record(((channels[index].stream, verdict) for (_, index), verdict in zip(pending, probed)), now, probe_mode)
+
+    working = 0
+    for channel, verdict in zip(channels, results):
+        if verdict.ok:
+            log.debug("Channel %s - Stream is working.", channel.tvg_id)
+            working += 1
         else:
-            print(f"Channel {channel['tvg-id']} - Duplicate stream found, skipping")
+            log.debug("Channel %s - Stream is not working or blocked (%s).", channel.tvg_id, verdict.reason)
+            metrics.failure("probe", verdict.reason)
+    metrics.count("probe.working", working)
+    log.info("%d of %d streams are working.", working, len(channels))
 
-    return valid_channels
+    return results
 
-def extract_channel_name(extinf_line):
-    return extinf_line.split(",", 1)[1].strip()
+# Параметры, которые не влияют на содержимое потока и мешают находить дубликаты
+TRACKING_PARAMS = frozenset({
+    "utm_source", "utm_medium", "utm_campaign", "utm_term", "utm_content",
+    "fbclid", "gclid", "yclid", "_",
+})
+DEFAULT_PORTS = {"http": 80, "https": 443, "rtmp": 1935}
 
-async def merge_m3u_channels_without_check(channels1):
-    valid_channels = []
-    existing_urls = set()
-
-    for channel in channels1:
-        stream_url = channel.get("stream")
-        if stream_url not in existing_urls:
-            valid_channels.append(channel)
-            existing_urls.add(stream_url)
+def canonical_stream_url(url):
+    try:
+        parts = urlsplit(url.strip())
+        port = parts.port
+    except ValueError:
+        return url.strip()
+    scheme = parts.scheme.lower()
+    netloc = (parts.hostname or "").lower()
+    if ":" in netloc:
+        netloc = f"[{netloc}]"
+    if port is not None and port != DEFAULT_PORTS.get(scheme):
+        netloc = f"{netloc}:{port}"
+    if parts.username is not None:
+        userinfo = parts.username if parts.password is None else f"{parts.username}:{parts.password}"
+        netloc = f"{userinfo}@{netloc}"
+    query = urlencode(sorted(
+        (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if key.lower() not in TRACKING_PARAMS
+    ))
+    return urlunsplit((scheme, netloc, parts.path or "/", query, ""))
+
+def channel_key(channel):
+    # tvg-id - это ключ EPG, его делят таймшифт и HD-версии канала, поэтому канал - пара (tvg-id, имя).
+    # Записи без того и другого не группируются: вызывающий подставляет канонический URL потока
+    tvg_id = channel.tvg_id.strip().casefold() if channel.tvg_id else ""
+    name = " ".join(channel.name.casefold().split())
+    if not tvg_id and not name:
+        return None
+    return tvg_id, name
+
+class ChannelIndex:
+    """Dedup index keyed by canonical stream URL and by channel identity.
+
+    Streams whose URLs only differ cosmetically are collapsed on ``add``;
+    entries for the same channel become mirrors of one group. ``offer``
+    keeps the best mirror of each group: the first one in source order,
+    or with verdicts the fastest working one. Groups are ordered by their
+    first entry, so the result does not depend on the order in which
+    downloads or probes finish.
+    """
+
+    def __init__(self):
+        self.urls = set()
+        # ключ канала -> [позиция первой записи, (ранг, позиция, канал) лучшего зеркала или None]
+        self.groups = {}
+        self.duplicates = 0
+
+    def add(self, channel, seq):
+        canonical = canonical_stream_url(channel.stream)
+        if canonical in self.urls:
+            self.duplicates += 1
+            return None
+        self.urls.add(canonical)
+        key = channel_key(channel) or canonical
+        group = self.groups.get(key)
+        if group is None:
+            self.groups[key] = [seq, None]
+        elif seq < group[0]:
+            group[0] = seq
+        return key
+
+    def offer(self, key, channel, seq, verdict=None):
+        if verdict is None:
+            rank = ()
+        elif verdict.ok:
+            # Из рабочих зеркал канала остаётся то, что ответило быстрее; без замера - в конец очереди
+            rank = (verdict.latency is None, verdict.latency or 0)
         else:
-            print(f"Duplicate stream found for {stream_url}, skipping.")
+            return
+        group = self.groups[key]
+        if group[1] is None or (rank, seq) < group[1][:2]:
+            group[1] = (rank, seq, channel)
+
+    def extend(self, channels):
+        for seq, channel in enumerate(channels):
+            key = self.add(channel, seq)
+            if key is not None:
+                self.offer(key, channel, seq)
+
+    def best(self):
+        groups = sorted((group for group in self.groups.values() if group[1] is not None), key=lambda group: group[0])
+        return [group[1][2] for group in groups]
+
+    def missing(self):
+        return sum(1 for group in self.groups.values() if group[1] is None)
+
+async def merge_m3u_channels_async(*channel_lists, health_cache=None, probe_mode="basic", scheduler=None, shards=VALIDATION_SHARDS):
+    index = ChannelIndex()
+    mirrors = []
+    for channel in (channel for channel_list in channel_lists for channel in channel_list):
+        key = index.add(channel, len(mirrors))
+        if key is not None:
+            mirrors.append((key, channel))
+    log.info("Collapsed %d duplicate streams, probing %d mirrors of %d channels.", index.duplicates, len(mirrors), len(index.groups))
+    metrics.count("merge.duplicates", index.duplicates)
+
+    results = await check_channels([channel for _, channel in mirrors], health_cache, probe_mode, scheduler, shards)
+    for seq, ((key, channel), verdict) in enumerate(zip(mirrors, results)):
+        index.offer(key, channel, seq, verdict)
+    metrics.count("merge.no_working_stream", index.missing())
+    return index.best()
 
+async def merge_m3u_channels_without_check(channels1):
+    index = ChannelIndex()
+    index.extend(channels1)
+    valid_channels = index.best()
+    skipped = len(channels1) - len(valid_channels)
+    if skipped:
+        log.info("Skipped %d duplicate streams and mirrors.", skipped)
+        metrics.count("merge.duplicates", skipped)
     return valid_channels
 
-def write_m3u(filename, channels, url_tvg, format_type):
-    with open(filename, "w", encoding="utf-8") as f:
-        f.write(f"{url_tvg}\n")
-
-        sorted_channels = sorted(channels, key=lambda channel: extract_channel_name(channel['info']).lower())
-
-        for channel in sorted_channels:
-            f.write(f"{channel['info']}\n")
-
-            stream_url = channel['stream']
-            if format_type == 'TiviMate':
-                if channel.get("user_agent"):
-                    stream_url += f'|User-Agent="{channel["user_agent"]}"'
-
-                if channel.get("referrer"):
-                    stream_url += f'|Referer="{channel["referrer"]}"'
-
-                if channel.get("http_origin"):
-                    stream_url += f'|Origin="{channel["http_origin"]}"'
-
-            elif format_type == 'Televizo':
-                if channel.get("referrer"):
-                    f.write(f"#EXTVLCOPT:http-referrer={channel['referrer']}\n")
-
-                if channel.get("http_origin"):
-                    f.write(f"#EXTVLCOPT:http-origin={channel['http_origin']}\n")
+async def merge_playlists_pipeline(sources, session, health_cache=None, probe_mode="basic", scheduler=None,
+                                   max_pending=PIPELINE_MAX_PENDING, shards=VALIDATION_SHARDS):
+    """Download, parse, dedup, validate and collect channels as overlapping stages.
+
+    Each source is parsed while it downloads; every new stream of a
+    checked source gets its own validation task, so a slow source overlaps
+    with probing of fast ones. Concurrency is left to the host scheduler:
+    a saturated host only holds its own tasks, never a shared worker, and
+    once ``max_pending`` streams await a verdict the downloads pause
+    instead of growing memory.
+    """
+    now = time.time()
+    known = health_cache.lookup() if health_cache else {}
+    pending = asyncio.Semaphore(max_pending)
+    tasks = set()
+    # Проверяемые и непроверяемые источники сливаются раздельно, как при слиянии списков по отдельности;
+    # в итоге сначала идут проверенные каналы, затем остальные, каждые в порядке источников
+    indexes = {True: ChannelIndex(), False: ChannelIndex()}
+    probed = []
+
+    checked = any(source.check for source in sources)
+    if scheduler is None:
+        scheduler = HostScheduler()
+    fallback = StreamlinkPool()
+    # В шардах у каждого процесса свой планировщик; общий лимит в родителе растёт вместе с числом процессов
+    shard_pool = ValidationShards(shards, probe_mode) if checked and shards > 1 else None
+
+    async def produce(index, source):
+        channel_index = indexes[source.check]
+        position = 0
+        async for batch in stream_playlist(source.url, session):
+            for channel in batch:
+                position += 1
+                if source.keep and not source.keep(channel):
+                    continue
+                seq = (index, position)
+                key = channel_index.add(channel, seq)
+                if key is None:
+                    continue
+                if source.check:
+                    await pending.acquire()
+                    task = asyncio.create_task(validate(key, seq, channel))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                else:
+                    channel_index.offer(key, channel, seq)
+
+    async def validate(key, seq, channel):
+        try:
+            entry = known.get(channel.stream)
+            if entry and health_cache.is_fresh(entry, now, probe_mode):
+                verdict = StreamVerdict(True, entry["latency"], None, entry["ttfb"], entry["throughput"])
+                metrics.count("probe.trusted")
+            elif shard_pool:
+                verdict = await shard_pool.check(channel)
+                probed.append((channel.stream, verdict))
+                metrics.count("probe.checked")
+            else:
+                # Неожиданная ошибка проверки не должна терять канал и место в лимите
+                try:
+                    verdict = await check_stream(
+                        channel.stream,
+                        user_agent=channel.user_agent,
+                        referer=channel.referrer,
+                        http_origin=channel.http_origin,
+                        session=session,
+                        scheduler=scheduler,
+                        fallback=fallback,
+                        probe_mode=probe_mode
+                    )
+                except Exception as e:
+                    log.exception("Probe of %s failed", channel.stream)
+                    verdict = StreamVerdict(False, None, type(e).__name__)
+                probed.append((channel.stream, verdict))
+                metrics.count("probe.checked")
+            if verdict.ok:
+                log.debug("Channel %s - Stream is working.", channel.tvg_id)
+                metrics.count("probe.working")
+            else:
+                log.debug("Channel %s - Stream is not working or blocked (%s).", channel.tvg_id, verdict.reason)
+                metrics.failure("probe", verdict.reason)
+            indexes[True].offer(key, channel, seq, verdict)
+        finally:
+            pending.release()
 
-                if channel.get("user_agent"):
-                    f.write(f"#EXTVLCOPT:http-user-agent={channel['user_agent']}\n")
+    try:
+        with metrics.stage("pipeline"):
+            await asyncio.gather(*(produce(index, source) for index, source in enumerate(sources)))
+            await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await fallback.close()
+        if shard_pool:
+            await shard_pool.close()
+
+    if health_cache and probed:
+        health_cache.record(probed, now, probe_mode)
+
+    channels = indexes[True].best() + indexes[False].best()
+    missing = indexes[True].missing()
+    duplicates = indexes[True].duplicates + indexes[False].duplicates
+    metrics.count("merge.duplicates", duplicates)
+    metrics.count("merge.no_working_stream", missing)
+    log.info("Pipeline collapsed %d duplicate streams, probed %d streams, published %d channels (%d without a working stream).",
+             duplicates, len(probed), len(channels), missing)
+    return channels
 
-            f.write(f"{stream_url}\n")
+# Форматы плейлистов: имя -> (файл, функция отрисовки, писать ли рядом .gz)
+PLAYLIST_FORMATS = {}
+DEFAULT_FORMATS = ("TiviMate", "Televizo")
+
+def playlist_format(name, filename, compress=True):
+    def register(render):
+        PLAYLIST_FORMATS[name] = (filename, render, compress)
+        return render
+    return register
+
+def sort_channels(channels):
+    return sorted(channels, key=lambda channel: channel.name.lower())
+
+@playlist_format("TiviMate", "tivimate.m3u")
+def render_tivimate(sorted_channels, url_tvg):
+    lines = [url_tvg]
+    for channel in sorted_channels:
+        stream_url = channel.stream
+        if channel.user_agent:
+            stream_url += f'|User-Agent="{channel.user_agent}"'
+        if channel.referrer:
+            stream_url += f'|Referer="{channel.referrer}"'
+        if channel.http_origin:
+            stream_url += f'|Origin="{channel.http_origin}"'
+        lines.append(channel.info)
+        lines.append(stream_url)
+    lines.append("")
+    return "\n".join(lines)
+
+@playlist_format("Televizo", "televizo.m3u")
+def render_televizo(sorted_channels, url_tvg):
+    lines = [url_tvg]
+    for channel in sorted_channels:
+        lines.append(channel.info)
+        if channel.referrer:
+            lines.append(f"#EXTVLCOPT:http-referrer={channel.referrer}")
+        if channel.http_origin:
+            lines.append(f"#EXTVLCOPT:http-origin={channel.http_origin}")
+        if channel.user_agent:
+            lines.append(f"#EXTVLCOPT:http-user-agent={channel.user_agent}")
+        lines.append(channel.stream)
+    lines.append("")
+    return "\n".join(lines)
+
+@playlist_format("JSON", "channels.json", compress=False)
+def render_json_index(sorted_channels, url_tvg):
+    return json.dumps([
+        {"name": channel.name, "tvg_id": channel.tvg_id, "category": channel.category, "stream": channel.stream}
+        for channel in sorted_channels
+    ], ensure_ascii=False)
+
+def write_playlist(filename, text, compress=True):
+    # Один вызов write на файл; .gz пишется из того же буфера
+    data = text.encode("utf-8")
+    with open(filename, "wb") as f:
+        f.write(data)
+    if compress:
+        with open(f"{filename}.gz", "wb") as f:
+            f.write(gzip.compress(data, compresslevel=9))
+
+def playlist_outputs(formats=DEFAULT_FORMATS):
+    outputs = []
+    for name in formats:
+        filename, _, compress = PLAYLIST_FORMATS[name]
+        outputs.append(filename)
+        if compress:
+            outputs.append(f"{filename}.gz")
+    return outputs
+
+def channel_set_digest(channels, url_tvg, formats=DEFAULT_FORMATS):
+    # Хэш всего, из чего строятся плейлисты: совпал - файлы получатся байт в байт прежними
+    parts = [url_tvg, *formats]
+    parts.extend("\t".join(value or "" for value in channel.to_row()) for channel in channels)
+    return content_digest(parts)
+
+def render_playlists(channels, url_tvg, formats=DEFAULT_FORMATS, write=True):
+    sorted_channels = sort_channels(channels)
+    rendered = {}
+    for name in formats:
+        filename, render, compress = PLAYLIST_FORMATS[name]
+        with metrics.stage("render"):
+            rendered[name] = render(sorted_channels, url_tvg)
+        if write:
+            with metrics.stage("write"):
+                write_playlist(filename, rendered[name], compress)
+            log.info("%s playlist written to %s%s", name, filename, f" and {filename}.gz" if compress else "")
+    return rendered
+
+def write_m3u(filename, channels, url_tvg, format_type, compress=True):
+    render = PLAYLIST_FORMATS[format_type][1]
+    write_playlist(filename, render(sort_channels(channels), url_tvg), compress)
 
 async def main():
     parser = argparse.ArgumentParser(description="Merge and validate IPTV m3u playlists.")
@@ -360,46 +1651,49 @@ async def main():
     parser.add_argument("url5", help="URL to the fifth m3u file")
     parser.add_argument("url6", help="URL to the sixth m3u file")
     parser.add_argument("url7", help="URL to the seventh m3u file with Torrent TV channels")
+    parser.add_argument("--health-ttl", type=float, default=HEALTH_TTL_HOURS,
+                        help="Hours a working stream verdict is trusted without re-probing (0 to always probe)")
+    parser.add_argument("--formats", nargs="+", choices=sorted(PLAYLIST_FORMATS), default=list(DEFAULT_FORMATS),
+                        help="Playlist formats to render from the merged channel list")
+    parser.add_argument("--probe-mode", choices=PROBE_MODES, default="basic",
+                        help="basic: check the channel URL only; deep: resolve HLS down to one segment within a byte/time budget")
+    parser.add_argument("--shards", type=int, default=VALIDATION_SHARDS,
+                        help="Validate streams in this many processes, split by host (1 keeps everything in this process)")
+    parser.add_argument("--log-level", choices=LOG_LEVELS, default="INFO", help="Logging verbosity (DEBUG shows every probe attempt)")
+    parser.add_argument("--report", default=RUN_REPORT_FILE, help="Where to write the JSON run report")
+    parser.add_argument("--force", action="store_true", help="Render the playlists even if the channel set is unchanged")
     args = parser.parse_args()
-
-    m3u_data1 = await download_m3u(args.url1)
-    m3u_data2 = await download_m3u(args.url2)
-    m3u_data3 = await download_m3u(args.url3)
-    m3u_data4 = await download_m3u(args.url4)
-    m3u_data5 = await download_m3u(args.url5)
-    m3u_data6 = await download_m3u(args.url6)
-    m3u_data7 = await download_m3u(args.url7)
+    setup_logging(args.log_level)
 
     url_tvg = extract_url_tvg()
 
-    channels1 = parse_m3u(m3u_data1)
-    channels2 = parse_m3u(m3u_data2)
-    channels3 = parse_m3u(m3u_data3)
-    channels4 = parse_m3u(m3u_data4)
-    channels5 = parse_m3u(m3u_data5)
-    channels6 = parse_m3u(m3u_data6)
-    channels7 = parse_m3u(m3u_data7)
-
-    torrent_tv_channels_7 = [
-        channel for channel in channels7
-        if channel.get("category") == "↕️ Торрент ТВ ↕️"
+    sources = [
+        #PlaylistSource(args.url1), PlaylistSource(args.url2), PlaylistSource(args.url3),
+        #PlaylistSource(args.url4), PlaylistSource(args.url5),
+        PlaylistSource(args.url6, check=False),
+        #PlaylistSource(args.url7, check=False, keep=lambda channel: channel.category == "↕️ Торрент ТВ ↕️"),
     ]
 
-    #merged_channels_123456 = await merge_m3u_channels_async(channels1, channels2, channels3, channels4, channels5)
-
-    merged_torrent_tv_channels = await merge_m3u_channels_without_check(
-        #channels6 + torrent_tv_channels_7
-        channels6
-    )
-
-    #merged_channels = merged_channels_123456 + merged_torrent_tv_channels
-    merged_channels = merged_torrent_tv_channels
-
-    write_m3u("tivimate.m3u", merged_channels, url_tvg, "TiviMate")
-    print("TiviMate playlist written to tivimate.m3u")
-
-    write_m3u("televizo.m3u", merged_channels, url_tvg, "Televizo")
-    print("Televizo playlist written to televizo.m3u")
+    health_cache = StreamHealthCache(ttl=args.health_ttl * 3600)
+    try:
+        async with create_http_session() as session:
+            merged_channels = await merge_playlists_pipeline(sources, session, health_cache, args.probe_mode, shards=args.shards)
+    finally:
+        health_cache.close()
+
+    metrics.count("output.channels", len(merged_channels))
+    digest = channel_set_digest(merged_channels, url_tvg, args.formats)
+    outputs = playlist_outputs(args.formats)
+    if not args.force and is_unchanged("playlists", digest, outputs):
+        log.info("Channel set unchanged since the last run, keeping %s.", ", ".join(outputs))
+        metrics.count("output.unchanged")
+        metrics.write_report(args.report, script="merge_m3u", probe_mode=args.probe_mode, formats=args.formats, changed=False)
+        return UNCHANGED_EXIT_CODE
+
+    render_playlists(merged_channels, url_tvg, args.formats)
+    record_manifest("playlists", digest, outputs)
+    metrics.write_report(args.report, script="merge_m3u", probe_mode=args.probe_mode, formats=args.formats, changed=True)
+    return 0
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    sys.exit(asyncio.run(main()))
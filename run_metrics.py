@@ -0,0 +1,148 @@
+import os
+import json
+import time
+import logging
+import threading
+import contextlib
+from collections import Counter, defaultdict
+
+LOG_LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR")
+
+log = logging.getLogger("playlist")
+
+class LevelFormatter(logging.Formatter):
+    # streamlink переименовывает уровни в нижний регистр, в логе они должны выглядеть одинаково
+    def formatMessage(self, record):
+        record.levelname = record.levelname.upper()
+        return super().formatMessage(record)
+
+def setup_logging(level="INFO"):
+    handler = logging.StreamHandler()
+    handler.setFormatter(LevelFormatter("%(asctime)s %(levelname)-7s %(message)s", datefmt="%H:%M:%S"))
+    logging.basicConfig(level=level, handlers=[handler])
+
+class RunMetrics:
+    """Counters, stage timers, per-host probe stats and failure reasons of one run.
+
+    Safe to update from worker threads; ``report`` turns everything into a
+    JSON-friendly dict that is written at the end of the run.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.counters = Counter()
+            self.timers = {}
+            self.hosts = {}
+            self.failures = defaultdict(Counter)
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                timer = self.timers[name] = [0, 0.0, 0.0]
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            self.add_time(name, elapsed)
+            log.debug("Stage %s took %.3fs", name, elapsed)
+
+    def failure(self, stage, reason):
+        with self.lock:
+            self.failures[stage][reason or "unknown"] += 1
+
+    def probe(self, host, latency=None, failed=False):
+        with self.lock:
+            stats = self.hosts.get(host)
+            if stats is None:
+                # probes, failures, сумма и максимум задержки, число замеров задержки
+                stats = self.hosts[host] = [0, 0, 0.0, 0.0, 0]
+            stats[0] += 1
+            if failed:
+                stats[1] += 1
+            if latency is not None:
+                stats[2] += latency
+                stats[3] = max(stats[3], latency)
+                stats[4] += 1
+
+    def snapshot(self):
+        # Сырые значения для передачи из дочернего процесса (см. merge)
+        with self.lock:
+            return {
+                "counters": dict(self.counters),
+                "timers": {name: list(timer) for name, timer in self.timers.items()},
+                "hosts": {host: list(stats) for host, stats in self.hosts.items()},
+                "failures": {stage: dict(reasons) for stage, reasons in self.failures.items()},
+            }
+
+    def merge(self, snapshot):
+        with self.lock:
+            self.counters.update(snapshot["counters"])
+            for name, (count, total, peak) in snapshot["timers"].items():
+                timer = self.timers.setdefault(name, [0, 0.0, 0.0])
+                timer[0] += count
+                timer[1] += total
+                timer[2] = max(timer[2], peak)
+            for host, (probes, failures, latency_total, latency_max, measured) in snapshot["hosts"].items():
+                stats = self.hosts.setdefault(host, [0, 0, 0.0, 0.0, 0])
+                stats[0] += probes
+                stats[1] += failures
+                stats[2] += latency_total
+                stats[3] = max(stats[3], latency_max)
+                stats[4] += measured
+            for stage, reasons in snapshot["failures"].items():
+                self.failures[stage].update(reasons)
+
+    def report(self, **extra):
+        with self.lock:
+            timers = {
+                name: {"count": count, "total": round(total, 3), "max": round(peak, 3)}
+                for name, (count, total, peak) in sorted(self.timers.items())
+            }
+            hosts = {
+                host: {
+                    "probes": probes,
+                    "failures": failures,
+                    "avg_latency": round(latency_total / measured, 3) if measured else None,
+                    "max_latency": round(latency_max, 3) if measured else None,
+                }
+                for host, (probes, failures, latency_total, latency_max, measured)
+                in sorted(self.hosts.items(), key=lambda item: -item[1][0])
+            }
+            return dict(
+                extra,
+                started_at=round(self.started, 3),
+                duration=round(time.time() - self.started, 3),
+                counters=dict(sorted(self.counters.items())),
+                timers=timers,
+                failures={stage: dict(reasons.most_common()) for stage, reasons in sorted(self.failures.items())},
+                hosts=hosts,
+            )
+
+    def write_report(self, path, **extra):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.report(**extra), f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, path)
+        log.info("Run report written to %s", path)
+
+metrics = RunMetrics()
@@ -0,0 +1,237 @@
+import time
+import gzip
+import asyncio
+import hashlib
+import argparse
+from email.utils import formatdate
+
+from aiohttp import web
+
+import merge_m3u
+import epg_grabber
+from run_metrics import LOG_LEVELS, log, metrics, setup_logging
+
+SERVER_HOST = "127.0.0.1"
+SERVER_PORT = 8080
+PLAYLIST_REFRESH_MINUTES = 15
+EPG_REFRESH_MINUTES = 180
+# Демон перепроверяет потоки чаще, чем cron: рабочий вердикт доверяется только час
+SERVER_HEALTH_TTL_HOURS = 1
+RETRY_AFTER_SECONDS = 30
+
+CONTENT_TYPES = {
+    ".m3u": "audio/x-mpegurl",
+    ".json": "application/json",
+    ".gz": "application/gzip",
+}
+
+class PublishedFile:
+    """Response body kept in memory, with an optional gzip variant and strong ETags for both."""
+
+    __slots__ = ("body", "gzipped", "content_type", "etag", "gzip_etag", "last_modified")
+
+    def __init__(self, body, content_type, gzipped=None):
+        self.body = body
+        self.gzipped = gzipped
+        self.content_type = content_type
+        self.etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+        self.gzip_etag = f'{self.etag[:-1]}-gzip"' if gzipped is not None else None
+        self.last_modified = formatdate(time.time(), usegmt=True)
+
+class ServerState:
+    """Everything the handlers read; refresh tasks replace whole values, never mutate them in place."""
+
+    def __init__(self):
+        self.files = {}
+        self.channels = []
+        self.channels_ready = asyncio.Event()
+        # Один планировщик на всё время работы: лимиты и предохранители хостов переживают обновления
+        self.scheduler = None
+        self.status = {"started_at": int(time.time())}
+
+def content_type(filename):
+    return next((value for suffix, value in CONTENT_TYPES.items() if filename.endswith(suffix)), "application/octet-stream")
+
+def publish(state, files):
+    # Набор файлов подменяется целиком: запрос видит либо старую, либо новую версию, но не смесь
+    state.files = {**state.files, **files}
+
+def guide_url(options):
+    # Свой гид сервер отдаёт только при заданных --epg; иначе клиенты берут его из релиза
+    if not options.epg_urls:
+        return merge_m3u.EPG_RELEASE_URL
+    base = options.public_url or f"http://{options.host}:{options.port}"
+    return f"{base.rstrip('/')}/{epg_grabber.EPG_GZ_FILE}"
+
+def render_playlist_files(channels, formats, epg_url):
+    rendered = merge_m3u.render_playlists(channels, merge_m3u.extract_url_tvg(epg_url), formats, write=False)
+    files = {}
+    for name, text in rendered.items():
+        filename, _, compress = merge_m3u.PLAYLIST_FORMATS[name]
+        body = text.encode("utf-8")
+        gzipped = gzip.compress(body, compresslevel=9, mtime=0)
+        files[filename] = PublishedFile(body, content_type(filename), gzipped)
+        if compress:
+            files[f"{filename}.gz"] = PublishedFile(gzipped, content_type(".gz"))
+    return files
+
+async def refresh_playlists(app):
+    options = app["options"]
+    state = app["state"]
+    if state.scheduler is None:
+        state.scheduler = merge_m3u.HostScheduler()
+    sources = [merge_m3u.PlaylistSource(url, check=not options.no_check) for url in options.urls]
+    # Кэш здоровья делает проверку инкрементальной: свежие рабочие потоки не перепроверяются
+    async with merge_m3u.create_http_session() as session:
+        channels = await merge_m3u.merge_playlists_pipeline(
+            sources, session, health_cache=app["health_cache"], probe_mode=options.probe_mode, scheduler=state.scheduler,
+            shards=options.shards
+        )
+
+    if not channels:
+        log.warning("Refresh produced no channels, keeping the previous playlists.")
+        return
+    publish(state, await asyncio.to_thread(render_playlist_files, channels, options.formats, guide_url(options)))
+    state.channels = channels
+    state.channels_ready.set()
+    state.status["channels"] = len(channels)
+    log.info("Published %d channels.", len(channels))
+
+def epg_filter_keys(channels):
+    tvg_ids = {channel.tvg_id.strip().lower() for channel in channels if channel.tvg_id}
+    names = {channel.name.strip().lower() for channel in channels}
+    return tvg_ids, names
+
+async def refresh_epg(app):
+    options = app["options"]
+    tvg_ids, names = epg_filter_keys(app["state"].channels)
+    window = None if options.keep_all else epg_grabber.epg_window(options.past_hours, options.future_days, step_hours=options.window_step)
+    results = await asyncio.to_thread(epg_grabber.download_epgs, options.epg_urls, tvg_ids, names, window)
+    if not results:
+        log.warning("No EPG sources could be downloaded, keeping the previous guide.")
+        return
+    with metrics.stage("epg.merge"):
+        guide = await asyncio.to_thread(epg_grabber.merge_epgs, results)
+    with metrics.stage("epg.compress"):
+        body = await asyncio.to_thread(epg_grabber.render_epg, guide)
+    publish(app["state"], {epg_grabber.EPG_GZ_FILE: PublishedFile(body, content_type(epg_grabber.EPG_GZ_FILE))})
+    log.info("Published EPG (%d bytes).", len(body))
+
+async def refresh_forever(app, name, refresh, interval, ready=None):
+    if ready is not None:
+        await ready.wait()
+    while True:
+        started = time.monotonic()
+        try:
+            await refresh(app)
+            app["state"].status[name] = {"refreshed_at": int(time.time()), "duration": round(time.monotonic() - started, 3)}
+        except Exception:
+            # Упавшее обновление не должно останавливать сервер: отдаём прежнюю версию
+            log.exception("Refresh of %s failed", name)
+            metrics.count(f"server.{name}.failed")
+        await asyncio.sleep(max(0, interval - (time.monotonic() - started)))
+
+async def background_refresh(app):
+    options = app["options"]
+    tasks = [asyncio.create_task(refresh_forever(app, "playlists", refresh_playlists, options.refresh * 60))]
+    if options.epg_urls:
+        tasks.append(asyncio.create_task(
+            refresh_forever(app, "epg", refresh_epg, options.epg_refresh * 60, ready=app["state"].channels_ready)
+        ))
+    yield
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    app["health_cache"].close()
+
+def accepts_gzip(header):
+    # q=0 означает явный отказ; собственное значение gzip важнее, чем "*"
+    weights = {}
+    for item in (header or "").split(","):
+        coding, *params = [part.strip() for part in item.split(";")]
+        weight = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        weights[coding.lower()] = weight
+    return weights.get("gzip", weights.get("*", 0.0)) > 0
+
+def etag_matches(header, etag):
+    if not header:
+        return False
+    tags = [tag.strip() for tag in header.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+async def serve_file(request):
+    files = request.app["state"].files
+    published = files.get(request.match_info["name"])
+    if published is None:
+        if not files:
+            raise web.HTTPServiceUnavailable(headers={"Retry-After": str(RETRY_AFTER_SECONDS)}, text="First refresh is still running")
+        raise web.HTTPNotFound()
+
+    body, etag = published.body, published.etag
+    headers = {"Cache-Control": "no-cache", "Last-Modified": published.last_modified}
+    if published.gzipped is not None:
+        headers["Vary"] = "Accept-Encoding"
+        if accepts_gzip(request.headers.get("Accept-Encoding")):
+            body, etag = published.gzipped, published.gzip_etag
+            headers["Content-Encoding"] = "gzip"
+    headers["ETag"] = etag
+
+    if etag_matches(request.headers.get("If-None-Match"), etag):
+        return web.Response(status=304, headers=headers)
+    return web.Response(body=body, headers=headers, content_type=published.content_type)
+
+async def serve_status(request):
+    state = request.app["state"]
+    return web.json_response(dict(
+        state.status,
+        files={name: {"bytes": len(published.body), "etag": published.etag} for name, published in state.files.items()},
+        metrics=metrics.report(),
+    ))
+
+def create_app(options):
+    app = web.Application()
+    app["options"] = options
+    app["state"] = ServerState()
+    app["health_cache"] = merge_m3u.StreamHealthCache(ttl=options.health_ttl * 3600)
+    app.router.add_get("/status", serve_status)
+    app.router.add_get("/{name}", serve_file)
+    app.cleanup_ctx.append(background_refresh)
+    return app
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve merged playlists and the filtered EPG from memory, refreshing them in the background.")
+    parser.add_argument("urls", nargs="+", help="Playlist URLs to merge")
+    parser.add_argument("--epg", dest="epg_urls", action="append", default=[], help="EPG URL (repeat for several sources; earlier sources win overlapping programmes)")
+    parser.add_argument("--host", default=SERVER_HOST, help="Address to listen on")
+    parser.add_argument("--port", type=int, default=SERVER_PORT, help="Port to listen on")
+    parser.add_argument("--public-url",
+                        help=f"Base URL clients reach this server at (default http://HOST:PORT); url-tvg points at its /{epg_grabber.EPG_GZ_FILE}")
+    parser.add_argument("--refresh", type=float, default=PLAYLIST_REFRESH_MINUTES, help="Minutes between playlist refreshes")
+    parser.add_argument("--epg-refresh", type=float, default=EPG_REFRESH_MINUTES, help="Minutes between EPG refreshes")
+    parser.add_argument("--health-ttl", type=float, default=SERVER_HEALTH_TTL_HOURS,
+                        help="Hours a working stream verdict is trusted without re-probing")
+    parser.add_argument("--probe-mode", choices=merge_m3u.PROBE_MODES, default="basic", help="Stream probe mode")
+    parser.add_argument("--shards", type=int, default=merge_m3u.VALIDATION_SHARDS,
+                        help="Validate streams in this many processes, split by host")
+    parser.add_argument("--no-check", action="store_true", help="Publish deduplicated channels without validating streams")
+    parser.add_argument("--formats", nargs="+", choices=sorted(merge_m3u.PLAYLIST_FORMATS), default=list(merge_m3u.DEFAULT_FORMATS),
+                        help="Playlist formats to serve")
+    parser.add_argument("--past-hours", type=float, default=epg_grabber.EPG_WINDOW_PAST_HOURS,
+                        help="Keep at least the programmes that ended this many hours ago")
+    parser.add_argument("--future-days", type=float, default=epg_grabber.EPG_WINDOW_FUTURE_DAYS,
+                        help="Keep at least the programmes that start this many days ahead")
+    parser.add_argument("--window-step", type=float, default=epg_grabber.EPG_WINDOW_STEP_HOURS,
+                        help="Widen both EPG window ends outward to multiples of this many hours (UTC); the window grows by up to 2x this value (default %(default)s h); 0 disables")
+    parser.add_argument("--keep-all", action="store_true", help="Disable EPG time-window pruning")
+    parser.add_argument("--log-level", choices=LOG_LEVELS, default="INFO", help="Logging verbosity")
+    args = parser.parse_args()
+    setup_logging(args.log_level)
+
+    web.run_app(create_app(args), host=args.host, port=args.port, access_log=None)